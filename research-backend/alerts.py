@@ -0,0 +1,206 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+import smtplib
+import threading
+import uuid
+from pymongo.errors import DuplicateKeyError
+from metrics import span
+
+
+class AlertDispatcher:
+    # Sends dirty-water alerts off the request thread.
+    # Alerts are written to a Mongo outbox first, so nothing is lost if the process restarts,
+    # and a background loop groups pending alerts into one digest email per user.
+    # Every worker process runs this loop; a per-user lease document makes sure only one of them
+    # builds a given user's digest at a time, and alerts left 'sending' by a crashed worker are retried.
+
+    def __init__(self, outbox_col, users_col, smtp_host, smtp_port, sender, smtp_user=None, smtp_password=None,
+                 use_tls=True, cooldown=timedelta(hours=1), digest_window=timedelta(seconds=30), workers=2, max_attempts=5,
+                 leases_col=None, lease=timedelta(minutes=5)):
+        self.outbox_col = outbox_col
+        self.users_col = users_col
+        self.leases_col = leases_col if leases_col is not None else outbox_col.database['alert_leases']
+        self.lease = lease  # Longer than a send can take (the SMTP timeout is 30s)
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.sender = sender
+        self.smtp_user = smtp_user
+        self.smtp_password = smtp_password
+        self.use_tls = use_tls
+        self.cooldown = cooldown
+        self.digest_window = digest_window
+        self.max_attempts = max_attempts
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="alert-worker")
+        self.local = threading.local()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.sent = 0
+        self.suppressed = 0
+        self.failed = 0
+        self.recovered = 0
+
+    def notify_status(self, system, new_status):
+        # system is the document as it was before the update, so its status is the previous state
+        if new_status != 'dirty' or system.get('status') == 'dirty':
+            return False
+
+        now = datetime.utcnow()
+        recent = self.outbox_col.find_one({
+            'system_id': system['_id'],
+            'state': new_status,
+            'created_at': {'$gt': now - self.cooldown}
+        }, {'_id': 1})
+        if recent:
+            self.suppressed += 1
+            return False
+
+        self.outbox_col.insert_one({
+            'system_id': system['_id'],
+            'system_name': system['name'],
+            'username': system.get('username'),
+            'state': new_status,
+            'created_at': now,
+            'status': 'pending',
+            'attempts': 0
+        })
+        return True
+
+    def start(self, poll_interval=5.0):
+        if self.thread is None or not self.thread.is_alive():
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run, args=(poll_interval,), name="alert-dispatcher", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.executor.shutdown(wait=True)
+
+    def run(self, poll_interval):
+        while not self.stopping.is_set():
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Alert dispatcher error: {e}")
+            self.stopping.wait(poll_interval)
+
+    def flush(self, wait=False):
+        # Alerts claimed by a worker that died before finishing are put back once their lease has run out
+        now = datetime.utcnow()
+        recovered = self.outbox_col.update_many(
+            {'status': 'sending', 'claimed_at': {'$lte': now - self.lease}},
+            {'$set': {'status': 'pending'}, '$unset': {'claim': '', 'claimed_at': ''}, '$inc': {'attempts': 1}}
+        ).modified_count
+        if recovered:
+            print(f"Retrying {recovered} alerts left unsent by a stopped worker")
+            self.recovered += recovered
+
+        # A user's digest goes out once their oldest pending alert has waited digest_window
+        cutoff = now - self.digest_window
+        usernames = self.outbox_col.distinct('username', {'status': 'pending', 'created_at': {'$lte': cutoff}})
+        futures = [self.executor.submit(self.send_digest, username) for username in usernames]
+        if wait:
+            for future in futures:
+                future.result()
+        return len(futures)
+
+    def acquire(self, username, claim):
+        # Takes the user's lease unless another worker holds an unexpired one
+        now = datetime.utcnow()
+        try:
+            self.leases_col.find_one_and_update(
+                {'_id': username, 'expires_at': {'$lte': now}},
+                {'$set': {'claim': claim, 'expires_at': now + self.lease}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def send_digest(self, username):
+        claim = uuid.uuid4().hex
+        if not self.acquire(username, claim):
+            return  # Another worker is sending this user's digest
+        try:
+            self.send_claimed(username, claim)
+        finally:
+            self.leases_col.delete_one({'_id': username, 'claim': claim})
+
+    def send_claimed(self, username, claim):
+        self.outbox_col.update_many(
+            {'username': username, 'status': 'pending'},
+            {'$set': {'status': 'sending', 'claim': claim, 'claimed_at': datetime.utcnow()}}
+        )
+        alerts = list(self.outbox_col.find({'claim': claim}).sort('created_at', 1))
+        if not alerts:
+            return
+
+        user = self.users_col.find_one({'username': username}, {'email': 1})
+        if not user or 'email' not in user:
+            self.outbox_col.update_many({'claim': claim}, {'$set': {'status': 'dropped'}})
+            return
+
+        try:
+            self.send(self.build_digest(username, user['email'], alerts))
+        except Exception as e:
+            print(f"Failed to send email alert: {e}")
+            self.failed += 1
+            self.outbox_col.update_many({'claim': claim, 'attempts': {'$gte': self.max_attempts - 1}}, {'$set': {'status': 'failed'}})
+            self.outbox_col.update_many({'claim': claim, 'status': 'sending'}, {'$set': {'status': 'pending'}, '$unset': {'claimed_at': ''},
+                                                                              '$inc': {'attempts': 1}})
+            return
+
+        self.sent += 1
+        self.outbox_col.update_many({'claim': claim}, {'$set': {'status': 'sent', 'sent_at': datetime.utcnow()}})
+
+    def build_digest(self, username, email, alerts):
+        names = [alert['system_name'] for alert in alerts]
+        msg = EmailMessage()
+        msg['From'] = self.sender
+        msg['To'] = email
+
+        if len(names) == 1:
+            msg['Subject'] = "Alert: Water Quality is Dirty"
+            msg.set_content(f"Hi {username},\n\nYour water monitoring system '{names[0]}' has detected dirty water quality. Please take the necessary action.\n\nRegards,\nSensorData Team")
+        else:
+            msg['Subject'] = f"Alert: Water Quality is Dirty in {len(names)} systems"
+            listing = "\n".join(f"  - {name}" for name in names)
+            msg.set_content(f"Hi {username},\n\nThe following water monitoring systems have detected dirty water quality:\n\n{listing}\n\nPlease take the necessary action.\n\nRegards,\nSensorData Team")
+        return msg
+
+    def connection(self):
+        # Each worker keeps one SMTP connection open across messages
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            try:
+                if conn.noop()[0] == 250:
+                    return conn
+            except (smtplib.SMTPException, OSError):
+                pass
+
+        conn = smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=30)
+        if self.use_tls:
+            conn.starttls()
+        if self.smtp_user and self.smtp_password:
+            conn.login(self.smtp_user, self.smtp_password)
+        self.local.conn = conn
+        return conn
+
+    def send(self, msg):
+        with span('email'):
+            try:
+                self.connection().send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                self.local.conn = None
+                self.connection().send_message(msg)
+
+    def stats(self):
+        return {
+            'pending': self.outbox_col.count_documents({'status': 'pending'}),
+            'sent': self.sent,
+            'suppressed': self.suppressed,
+            'failed': self.failed,
+            'recovered': self.recovered,
+        }
@@ -1,47 +1,103 @@
 #app.py
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify
 from flask_cors import CORS
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
+from PIL import UnidentifiedImageError
 from flask_mail import Mail, Message
 from dotenv import load_dotenv
-from werkzeug.utils import secure_filename
-from PIL import Image
 import os
 import random
 import string
 from datetime import datetime, timedelta
 
 # ML Inference Import
-from ml_scripts import get_inference
+from ml_scripts import classify_image_bytes, get_batcher, get_engine, init_worker_inference, preload_engine, result_cache, InferenceQueueFull
+from alerts import AlertDispatcher
+from db_indexes import ensure_indexes
+from readings import ReadingStore
+from system_status import DASHBOARD_PROJECTION, parse_timestamp, store_latest_status, to_dashboard_entry
+from status_events import STATUS_EVENTS_COLLECTION, publish_change
+from profile_photo_endpoints import photo_store, profile_photos
+from metrics import MongoListener, init_app, span
 
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
-CORS(app)
-
-# MongoDB setup
-client = MongoClient("mongodb://localhost:27017")
-db = client["mydb"]
-systems_col = db["systems"]
-users_col = db["users"]
-reset_codes_col = db["reset_codes"]
+CORS(app, expose_headers=['X-Next-Cursor'])  # Browsers hide non-safelisted headers from cross-origin JS otherwise
+app.register_blueprint(profile_photos)
+init_app(app, slow_request_ms=float(os.getenv('SLOW_REQUEST_MS')) if os.getenv('SLOW_REQUEST_MS') else None)
 
 # Email config
-app.config['MAIL_SERVER'] = 'smtp.gmail.com'
-app.config['MAIL_PORT'] = 587
+app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER', 'smtp.gmail.com')
+app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT', '587'))
 app.config['MAIL_USERNAME'] = os.getenv('EMAIL_USER')
 app.config['MAIL_PASSWORD'] = os.getenv('EMAIL_PASS')
-app.config['MAIL_USE_TLS'] = True
+app.config['MAIL_USE_TLS'] = os.getenv('MAIL_USE_TLS', 'true').lower() == 'true'
 app.config['MAIL_USE_SSL'] = False
 
-mail = Mail(app)
+mail = Mail(app)  # Opens a connection per send, so it is safe to create before forking
+
+MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017')
+READINGS_DIR = os.path.join(os.path.dirname(__file__), 'readings')
+
+# Mongo connection pools and background threads don't survive a fork, so they are created per process
+# by init_worker(): from gunicorn's post_fork hook in production (see gunicorn.conf.py), or in __main__ for the dev server
+client = db = systems_col = users_col = reset_codes_col = status_events_col = None
+reading_store = alert_dispatcher = None
+
+
+def init_worker(start_alerts=True, torch_threads=None):
+    global client, db, systems_col, users_col, reset_codes_col, status_events_col, reading_store, alert_dispatcher
+
+    client = MongoClient(MONGO_URI, event_listeners=[MongoListener()])
+    db = client["mydb"]
+    systems_col = db["systems"]
+    users_col = db["users"]
+    reset_codes_col = db["reset_codes"]
+    # Status changes for dashboards; streamed to them by status_stream.py
+    status_events_col = db[STATUS_EVENTS_COLLECTION]
+    ensure_indexes(db)
+    photo_store.bind(users_col)
+
+    reading_store = ReadingStore(db["readings"], READINGS_DIR, rollups_col=db["reading_rollups"]).start()
+
+    # Dirty-water alerts go through a Mongo outbox and are sent in the background
+    alert_dispatcher = AlertDispatcher(
+        outbox_col=db["alert_outbox"],
+        users_col=users_col,
+        smtp_host=app.config['MAIL_SERVER'],
+        smtp_port=app.config['MAIL_PORT'],
+        sender=app.config['MAIL_USERNAME'],
+        smtp_user=app.config['MAIL_USERNAME'],
+        smtp_password=app.config['MAIL_PASSWORD'],
+        use_tls=app.config['MAIL_USE_TLS'],
+        cooldown=timedelta(minutes=int(os.getenv('ALERT_COOLDOWN_MINUTES', '60'))),
+        digest_window=timedelta(seconds=int(os.getenv('ALERT_DIGEST_SECONDS', '30')))
+    )
+    if start_alerts:
+        alert_dispatcher.start()
+
+    init_worker_inference(threads=torch_threads)  # Loads/warms the model and starts the micro-batcher
+    return app
 
-PROFILE_PHOTO_DIR = os.path.join(os.path.dirname(__file__), 'profile_photos')
-os.makedirs(PROFILE_PHOTO_DIR, exist_ok=True)
 
-DUMMY_IMAGE_PATH = 'dummy_images/placeholder.jpg'  # Must exist for inference
+def create_app(preload_model=True, init=True):
+    # WSGI app factory. Under gunicorn with preload_app the master calls create_app(init=False): the model
+    # weights are loaded once before forking and shared copy-on-write, and each worker runs init_worker()
+    # from post_fork. Servers that spawn workers instead of forking them use the default init=True
+    if preload_model:
+        preload_engine()
+    if init:
+        init_worker()
+    return app
+
+
+MAX_SYSTEMS_PAGE = 500
+
 
 def generate_reset_code():
     return ''.join(random.choices(string.digits, k=6))
@@ -59,7 +115,15 @@ def add_system():
     if systems_col.find_one({'name': system_name, 'username': username}):
         return jsonify({'success': False, 'message': 'Duplicate system name'}), 400
     
-    systems_col.insert_one({'name': system_name, 'username': username})
+    system = {'name': system_name, 'username': username}
+    if data.get('camera_url'):
+        system['camera_url'] = data['camera_url']  # Picked up by fleet_poller.py
+        system['poll_interval'] = data.get('poll_interval', 60)
+
+    try:
+        systems_col.insert_one(system)
+    except DuplicateKeyError:  # Added by a concurrent request since the check above
+        return jsonify({'success': False, 'message': 'Duplicate system name'}), 400
     return jsonify({'success': True, 'message': 'System added'}), 200
 
 
@@ -79,43 +143,104 @@ def get_systems_data():
     if not username:
         return jsonify([])
 
-    systems_cursor = systems_col.find({'username': username})
-    systems = []
-
-    for system in systems_cursor:
-        try:
-            with Image.open(DUMMY_IMAGE_PATH) as img:
-                status = get_inference(img).lower()
-        except Exception as e:
-            print(f"Error during inference: {e}")
-            status = 'unknown'
-
-        # Send email if dirty
-        if status == 'dirty':
-            user = users_col.find_one({'username': username})
-            if user and 'email' in user:
-                try:
-                    msg = Message(
-                        subject="Alert: Water Quality is Dirty",
-                        sender=app.config['MAIL_USERNAME'],
-                        recipients=[user['email']]
-                    )
-                    msg.body = f"Hi {username},\n\nYour water monitoring system '{system['name']}' has detected dirty water quality. Please take the necessary action.\n\nRegards,\nSensorData Team"
-                    mail.send(msg)
-                    print(f"Email alert sent to {user['email']}")
-                except Exception as e:
-                    print(f"Failed to send email alert: {e}")
-
-        systems.append({
-            'id': str(system['_id']),
-            'name': system['name'],
-            'status': status,
-            'lastUpdated': datetime.utcnow().isoformat(),
-            'confidence': round(random.uniform(85, 99), 2),
-            'imageUrl': f"/api/latest-image/{system['name']}"
-        })
-
-    return jsonify(systems)
+    # Status is written by the ingestion path, so this is a single indexed read.
+    # Optional keyset pagination over the (username, name) index: ?limit=N&cursor=<last name>
+    query = {'username': username}
+    cursor = request.args.get('cursor')
+    if cursor:
+        query['name'] = {'$gt': cursor}
+
+    systems = systems_col.find(query, DASHBOARD_PROJECTION).sort('name', 1)
+
+    limit = request.args.get('limit', type=int)
+    if limit:
+        limit = min(max(limit, 1), MAX_SYSTEMS_PAGE)
+        systems = list(systems.limit(limit + 1))
+        has_more = len(systems) > limit
+        systems = systems[:limit]
+    else:
+        systems = list(systems)
+        has_more = False
+
+    response = jsonify([to_dashboard_entry(system) for system in systems])
+    if has_more:
+        response.headers['X-Next-Cursor'] = systems[-1]['name']
+    return response
+
+
+@app.route('/ingest_image', methods=['POST'])
+def ingest_image():
+    system_id = request.form.get('system_id')
+
+    if 'image' not in request.files or not system_id:
+        return jsonify({'success': False, 'message': 'Image and system ID required'}), 400
+
+    try:
+        captured_at = parse_timestamp(request.form.get('captured_at'))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'captured_at must be an ISO 8601 timestamp'}), 400
+
+    # Checked before inference so bad requests don't cost a forward pass
+    if not ObjectId.is_valid(system_id):
+        return jsonify({'success': False, 'message': 'Invalid system ID'}), 400
+    if not systems_col.count_documents({'_id': ObjectId(system_id)}, limit=1):
+        return jsonify({'success': False, 'message': 'System not found'}), 404
+
+    image = request.files['image'].read()
+    try:
+        with span('inference'):
+            label, confidence = classify_image_bytes([image])[0]
+    except InferenceQueueFull as e:
+        print(f"Inference overloaded: {e}")
+        return jsonify({'success': False, 'message': 'Inference server busy, try again'}), 503
+    except (UnidentifiedImageError, OSError) as e:
+        print(f"Undecodable image for system {system_id}: {e}")
+        return jsonify({'success': False, 'message': 'Image could not be decoded'}), 400
+
+    status = label.lower()
+    system = store_latest_status(systems_col, system_id, status, confidence, captured_at)
+    if not system:  # Deleted meanwhile
+        return jsonify({'success': False, 'message': 'System not found'}), 404
+
+    reading_store.add(system_id, status, confidence, captured_at, image=image)
+    alert_dispatcher.notify_status(system, status)
+    publish_change(status_events_col, system, status, confidence, captured_at)
+
+    return jsonify({'success': True, 'status': status, 'confidence': confidence})
+
+
+@app.route('/systems/<system_id>/readings', methods=['GET'])
+def system_readings(system_id):
+    hours = request.args.get('hours', 24, type=float)
+    end = datetime.utcnow()
+
+    try:
+        readings = reading_store.history(system_id, end - timedelta(hours=hours), end, limit=request.args.get('limit', type=int))
+    except InvalidId:
+        return jsonify({'success': False, 'message': 'Invalid system ID'}), 400
+
+    for reading in readings:
+        reading['timestamp'] = reading['timestamp'].isoformat()
+    return jsonify(readings)
+
+
+@app.route('/systems/<system_id>/history', methods=['GET'])
+def system_history(system_id):
+    # Served from precomputed rollups, so cost depends on the number of buckets, not readings
+    days = request.args.get('days', 7, type=float)
+    granularity = request.args.get('granularity', 'hour' if days <= 7 else 'day')
+    if granularity not in ('hour', 'day'):
+        return jsonify({'success': False, 'message': 'Granularity must be hour or day'}), 400
+
+    end = datetime.utcnow()
+    try:
+        buckets = reading_store.rollups(system_id, granularity, end - timedelta(days=days), end)
+    except InvalidId:
+        return jsonify({'success': False, 'message': 'Invalid system ID'}), 400
+
+    for bucket in buckets:
+        bucket['bucket'] = bucket['bucket'].isoformat()
+    return jsonify({'granularity': granularity, 'buckets': buckets})
 
 
 
@@ -132,7 +257,10 @@ def signup():
     if users_col.find_one({'username': username}):
         return jsonify({'success': False, 'message': 'Username exists'}), 400
     
-    users_col.insert_one({'username': username, 'password': password, 'email': email})
+    try:
+        users_col.insert_one({'username': username, 'password': password, 'email': email})
+    except DuplicateKeyError:  # Signed up by a concurrent request since the check above
+        return jsonify({'success': False, 'message': 'Username exists'}), 400
 
     try:
         msg = Message(
@@ -141,7 +269,8 @@ def signup():
             recipients=[email]
         )
         msg.body = f"Hi {username},\n\nYour account has been successfully created. Thank you for signing up!"
-        mail.send(msg)
+        with span('email'):
+            mail.send(msg)
     except Exception as e:
         print(f"Email sending failed: {e}")
 
@@ -174,7 +303,7 @@ def forgot_password():
         return jsonify({'success': False, 'message': 'Email not found'}), 404
     
     reset_code = generate_reset_code()
-    expiry_time = datetime.now() + timedelta(minutes=15)
+    expiry_time = datetime.utcnow() + timedelta(minutes=15)
     reset_codes_col.insert_one({
         'email': email,
         'code': reset_code,
@@ -196,7 +325,8 @@ This code will expire in 15 minutes. If you did not request this reset, please i
 
 Best regards,
 SensorData System Team"""
-        mail.send(msg)
+        with span('email'):
+            mail.send(msg)
         return jsonify({'success': True, 'message': 'Reset code sent to your email'})
     except Exception as e:
         print(f"Email sending failed: {e}")
@@ -216,7 +346,7 @@ def verify_reset_code():
         'email': email,
         'code': code,
         'used': False,
-        'expires_at': {'$gt': datetime.now()}
+        'expires_at': {'$gt': datetime.utcnow()}
     })
     
     if not reset_entry:
@@ -239,7 +369,7 @@ def reset_password():
         'email': email,
         'code': code,
         'used': False,
-        'expires_at': {'$gt': datetime.now()}
+        'expires_at': {'$gt': datetime.utcnow()}
     })
     
     if not reset_entry:
@@ -276,57 +406,10 @@ def delete_all_systems():
     return jsonify({'success': True, 'message': 'All systems deleted'})
 
 
-@app.route('/upload_profile_photo', methods=['POST'])
-def upload_profile_photo():
-    username = request.form.get('username')
-
-    if 'photo' not in request.files or not username:
-        return jsonify({'success': False, 'message': 'Photo and username required'}), 400
-    
-    file = request.files['photo']
-    if file.filename == '':
-        return jsonify({'success': False, 'message': 'No selected file'}), 400
-    
-    filename = secure_filename(f"{username}_profile_{file.filename}")
-    filepath = os.path.join(PROFILE_PHOTO_DIR, filename)
-    file.save(filepath)
-
-    users_col.update_one({'username': username}, {'$set': {'profile_photo': filename}})
-    return jsonify({'success': True, 'filename': filename})
-
-
-@app.route('/remove_profile_photo', methods=['POST'])
-def remove_profile_photo():
-    data = request.get_json()
-    username = data.get('username')
-    
-    user = users_col.find_one({'username': username})
-    if not user or 'profile_photo' not in user:
-        return jsonify({'success': False, 'message': 'No profile photo to remove'}), 400
-    
-    filename = user['profile_photo']
-    filepath = os.path.join(PROFILE_PHOTO_DIR, filename)
-    
-    if os.path.exists(filepath):
-        os.remove(filepath)
-    
-    users_col.update_one({'username': username}, {'$unset': {'profile_photo': ''}})
-    return jsonify({'success': True})
-
-
-@app.route('/profile_photo/<username>')
-def serve_profile_photo(username):
-    user = users_col.find_one({'username': username})
-    if not user or 'profile_photo' not in user:
-        return jsonify({'success': False, 'message': 'No profile photo'}), 404
-    
-    filename = user['profile_photo']
-    return send_from_directory(PROFILE_PHOTO_DIR, filename)
-
-
 @app.route('/update_system_status', methods=['POST'])
 def update_system_status():
-    data = request.get_json()
+    # JSON body, or multipart form with an 'image' file when a Pi in on-device mode uploads the frame
+    data = request.get_json(silent=True) or request.form
     system_id = data.get('system_id')
     new_status = data.get('status')
 
@@ -334,26 +417,27 @@ def update_system_status():
         return jsonify({'success': False, 'message': 'System ID and status required'}), 400
 
     try:
-        system = systems_col.find_one({'_id': ObjectId(system_id)})
+        captured_at = parse_timestamp(data.get('captured_at'))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'captured_at must be an ISO 8601 timestamp'}), 400
+
+    try:
+        confidence = data.get('confidence')
+        confidence = float(confidence) if confidence is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'confidence must be a number'}), 400
+
+    try:
+        system = store_latest_status(systems_col, system_id, new_status, confidence, captured_at)
         if not system:
             return jsonify({'success': False, 'message': 'System not found'}), 404
 
-        systems_col.update_one({'_id': ObjectId(system_id)}, {'$set': {'status': new_status}})
-
-        if new_status == 'dirty':
-            username = system.get('username')
-            user = users_col.find_one({'username': username})
-            if user and 'email' in user:
-                try:
-                    msg = Message(
-                        subject="Alert: Water Quality is Dirty",
-                        sender=app.config['MAIL_USERNAME'],
-                        recipients=[user['email']]
-                    )
-                    msg.body = f"Hi {username},\n\nYour water monitoring system '{system['name']}' has detected dirty water quality. Please take the necessary action.\n\nRegards,\nSensorData Team"
-                    mail.send(msg)
-                except Exception as e:
-                    print(f"Failed to send email alert: {e}")
+        if confidence is not None:
+            image = request.files['image'].read() if 'image' in request.files else None
+            reading_store.add(system_id, new_status, confidence, captured_at, image=image)
+
+        alert_dispatcher.notify_status(system, new_status.lower())
+        publish_change(status_events_col, system, new_status, confidence, captured_at)
 
         return jsonify({'success': True, 'message': 'System status updated'})
 
@@ -362,5 +446,15 @@ def update_system_status():
         return jsonify({'success': False, 'message': 'An error occurred'}), 500
 
 
+@app.route('/inference_stats', methods=['GET'])
+def inference_stats():
+    return jsonify({'engine': get_engine().stats(), 'batcher': get_batcher().stats(), 'cache': result_cache.stats()})
+
+
 if __name__ == '__main__':
+    # Development server only; for production use gunicorn -c gunicorn.conf.py
+    # debug=True runs this block in the reloader's watcher process too, which never serves a request;
+    # only the child it spawns (WERKZEUG_RUN_MAIN set) loads the model and starts the background threads
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        init_worker()
     app.run(debug=True)
@@ -0,0 +1,333 @@
+#Offline benchmark suite: inference latency, batch throughput, /get_systems_data end to end and the Pi frame path.
+#Mongo is replaced by mongomock and email goes to a local SMTP stub, so nothing leaves the machine.
+#Usage: python benchmark.py [--output bench.json] [--random-weights]
+#Compare runs with e.g. `python -m json.tool bench.json` across commits.
+import argparse
+import base64
+import json
+import os
+import socketserver
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from io import BytesIO
+from types import SimpleNamespace
+import mongomock
+import numpy as np
+from PIL import Image
+
+
+class SMTPStubHandler(socketserver.StreamRequestHandler):
+    #Just enough SMTP to accept messages; they are counted and discarded
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.reply("220 stub ESMTP")
+        in_data = False
+        for raw in self.rfile:
+            line = raw.decode(errors='replace').rstrip('\r\n')
+            if in_data:
+                if line == '.':
+                    in_data = False
+                    self.server.messages += 1
+                    self.reply("250 OK")
+                continue
+
+            command = line[:4].upper()
+            if command == 'EHLO':
+                self.reply("250 stub")
+            elif command == 'DATA':
+                in_data = True
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+            elif command == 'QUIT':
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class SMTPStub(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPStubHandler)
+        self.messages = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def summary(samples):
+    samples = sorted(samples)
+    return {
+        'n': len(samples),
+        'mean_ms': round(statistics.fmean(samples), 3),
+        'p50_ms': round(samples[len(samples) // 2], 3),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+    }
+
+
+def test_frame(seed=0):
+    #Smooth synthetic 480x640 scene so JPEG/PNG sizes are closer to a real tank than pure noise
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:480, 0:640]
+    frame = np.stack([(x / 640 * 255), (y / 480 * 255), np.full_like(x, 128)], axis=2)
+    return np.clip(frame + rng.normal(0, 8, frame.shape), 0, 255).astype(np.uint8)
+
+
+def encode(frame, fmt):
+    buffer = BytesIO()
+    Image.fromarray(frame).save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def bench_inference(ml_scripts, repeat):
+    frame = Image.fromarray(test_frame())
+
+    start = time.perf_counter()
+    engine = ml_scripts.InferenceEngine()
+    engine.predict(frame)
+    cold_ms = (time.perf_counter() - start) * 1000
+
+    return {
+        'cold_ms': round(cold_ms, 3),
+        'load_ms': engine.stats()['load_time_ms'],
+        'warm': summary(timed(lambda: engine.predict(frame), repeat)),
+    }, engine
+
+
+def bench_batches(engine, batch_sizes, repeat):
+    results = []
+    for size in batch_sizes:
+        if size > engine.max_batch_size:
+            continue
+        images = [Image.fromarray(test_frame(i)) for i in range(size)]
+        samples = timed(lambda: engine.predict_batch(images, max_batch_size=size), repeat)
+        results.append({
+            'batch_size': size,
+            **summary(samples),
+            'images_per_sec': round(size / (statistics.fmean(samples) / 1000), 2),
+        })
+    return results
+
+
+def bench_dashboard(app_module, system_counts, repeat):
+    client = app_module.app.test_client()
+    results = []
+    for count in system_counts:
+        username = f"bench_{count}"
+        app_module.users_col.insert_one({'username': username, 'password': 'x', 'email': f"{username}@example.com"})
+        ids = app_module.systems_col.insert_many([{'name': f"tank_{i:04d}", 'username': username} for i in range(count)]).inserted_ids
+        for system_id in ids:
+            app_module.store_latest_status(app_module.systems_col, system_id, 'clean', 0.97)
+
+        samples = timed(lambda: client.get(f"/get_systems_data?username={username}").get_json(), repeat)
+        results.append({'systems': count, **summary(samples)})
+    return results
+
+
+def bench_alerts(app_module, smtp, systems=20):
+    #Dirty transitions for one user go through the outbox and leave as a single digest
+    username = 'bench_alerts'
+    app_module.users_col.insert_one({'username': username, 'password': 'x', 'email': f"{username}@example.com"})
+    ids = app_module.systems_col.insert_many([{'name': f"alert_{i}", 'username': username} for i in range(systems)]).inserted_ids
+    client = app_module.app.test_client()
+
+    samples = []
+    for system_id in ids:
+        start = time.perf_counter()
+        client.post('/update_system_status', json={'system_id': str(system_id), 'status': 'dirty'})
+        samples.append((time.perf_counter() - start) * 1000)
+
+    dispatcher = app_module.alert_dispatcher
+    dispatcher.digest_window = dispatcher.digest_window * 0
+    before = smtp.messages
+    start = time.perf_counter()
+    dispatcher.flush(wait=True)
+    flush_ms = (time.perf_counter() - start) * 1000
+
+    return {
+        'update_system_status': summary(samples),
+        'digest_flush_ms': round(flush_ms, 3),
+        'emails_sent': smtp.messages - before,
+        'dirty_systems': systems,
+    }
+
+
+def bench_status_stream(app_module, subscribers=1000, changes=20):
+    #Dashboards on the status stream server (status_stream.py), each an HTTP connection like a browser's EventSource.
+    #Changes go through /update_system_status and reach the stream server via the status_events collection;
+    #repeats of the same status must not emit. Under mongomock there is no tailable cursor, so fan-out includes
+    #the tailer's poll interval
+    import asyncio
+    import aiohttp
+    from aiohttp import web
+    import status_stream
+
+    username = 'bench_stream'
+    system_id = str(app_module.systems_col.insert_one({'name': 'stream_tank', 'username': username, 'status': 'clean'}).inserted_id)
+    client = app_module.app.test_client()
+    stream_app = status_stream.create_app(app_module.systems_col, app_module.status_events_col, poll_interval=0.05)
+
+    async def run():
+        runner = web.AppRunner(stream_app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        url = f"http://127.0.0.1:{runner.addresses[0][1]}/systems/stream?username={username}"
+
+        received = [[] for _ in range(subscribers)]
+        connected = [asyncio.Event() for _ in range(subscribers)]
+
+        async def dashboard(session, index):
+            async with session.get(url) as response:
+                async for line in response.content:
+                    if line.startswith(b'event: snapshot'):
+                        connected[index].set()
+                    elif line.startswith(b'event: status'):
+                        received[index].append(time.perf_counter())
+
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0), timeout=aiohttp.ClientTimeout(total=None))
+        tasks = [asyncio.create_task(dashboard(session, i)) for i in range(subscribers)]
+        start = time.perf_counter()
+        await asyncio.wait_for(asyncio.gather(*(event.wait() for event in connected)), 120)
+        connect_seconds = time.perf_counter() - start
+
+        published_at = []
+        request_samples = []
+        for i in range(changes):
+            status = 'dirty' if i % 2 == 0 else 'clean'
+            start = time.perf_counter()
+            await asyncio.to_thread(client.post, '/update_system_status', json={'system_id': system_id, 'status': status})
+            published_at.append(start)
+            request_samples.append((time.perf_counter() - start) * 1000)
+
+            #Let each change reach every dashboard so fanout_to_all isn't measuring a backlog
+            deadline = time.monotonic() + 10
+            while time.monotonic() < deadline and any(len(times) <= i for times in received):
+                await asyncio.sleep(0.001)
+            await asyncio.to_thread(client.post, '/update_system_status', json={'system_id': system_id, 'status': status})  # Not a change, must not emit
+
+        await asyncio.sleep(0.2)
+        stats = stream_app['broker'].stats()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await session.close()
+        await runner.cleanup()
+
+        fanout = [(max(times[i] for times in received if len(times) > i) - published_at[i]) * 1000 for i in range(changes)
+                  if any(len(times) > i for times in received)]
+        return {
+            'subscribers': subscribers,
+            'connect_all_seconds': round(connect_seconds, 3),
+            'status_changes': changes,
+            'unchanged_updates': changes,
+            'events_delivered': sum(len(times) for times in received),
+            'events_expected': subscribers * changes,
+            'events_dropped': stats['dropped'],
+            'update_system_status': summary(request_samples),
+            'fanout_to_all': summary(fanout),
+        }
+
+    return asyncio.run(run())
+
+
+def bench_frame_path(pi_functions, repeat):
+    frame = test_frame()
+    bgr = np.ascontiguousarray(frame[..., ::-1])
+    png_b64 = base64.b64encode(encode(bgr, 'PNG')).decode()
+    jpeg = encode(frame, 'JPEG')
+    raw = bgr.tobytes()
+
+    def response(content, headers):
+        return SimpleNamespace(content=content, headers=headers)
+
+    return {
+        'base64_png_json': {
+            'bytes_per_frame': len(png_b64),
+            'encode': summary(timed(lambda: base64.b64encode(encode(bgr, 'PNG')), repeat)),
+            'decode': summary(timed(lambda: pi_functions.decode_image(png_b64).load(), repeat)),
+        },
+        'binary_jpeg': {
+            'bytes_per_frame': len(jpeg),
+            'encode': summary(timed(lambda: encode(frame, 'JPEG'), repeat)),
+            'decode': summary(timed(lambda: pi_functions.decode_frame(response(jpeg, {'X-Frame-Format': 'jpeg'})).load(), repeat)),
+        },
+        'binary_raw': {
+            'bytes_per_frame': len(raw),
+            'encode': summary(timed(lambda: bgr.tobytes(), repeat)),
+            'decode': summary(timed(lambda: pi_functions.decode_frame(response(raw, {
+                'X-Frame-Format': 'raw', 'X-Frame-Shape': '480,640,3', 'X-Frame-Channels': 'BGR'})), repeat)),
+        },
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--batch-sizes', default='1,4,8,16')
+    parser.add_argument('--systems', default='1,10,100')
+    parser.add_argument('--random-weights', action='store_true', help='benchmark an untrained model when ML/First Trial is not available')
+    args = parser.parse_args()
+
+    smtp = SMTPStub()
+    # Set before app loads .env (load_dotenv never overrides) so no real credentials reach the stub
+    os.environ.update({'MAIL_SERVER': '127.0.0.1', 'MAIL_PORT': str(smtp.port), 'MAIL_USE_TLS': 'false',
+                       'EMAIL_USER': 'bench@example.com', 'EMAIL_PASS': ''})
+
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    if args.random_weights:
+        import torch
+        from ml_scripts import build_model
+        model = build_model()
+        model(torch.zeros(1, 3, 480, 640))
+        os.environ['MODEL_PATH'] = os.path.join(workdir, 'random_weights')
+        torch.save(model.state_dict(), os.environ['MODEL_PATH'])
+
+    with mongomock.patch(servers=(('localhost', 27017),)):
+        import ml_scripts
+        import importlib
+        importlib.reload(ml_scripts)  # Pick up MODEL_PATH set above
+        import app as app_module
+        import raspberry_pi_functions as pi_functions
+        app_module.init_worker(start_alerts=False)  # bench_alerts flushes the outbox itself
+
+        inference, engine = bench_inference(ml_scripts, args.repeat)
+        results = {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'inference': inference,
+            'batch_throughput': bench_batches(engine, [int(n) for n in args.batch_sizes.split(',')], max(3, args.repeat // 4)),
+            'get_systems_data': bench_dashboard(app_module, [int(n) for n in args.systems.split(',')], args.repeat),
+            'alerts': bench_alerts(app_module, smtp),
+            'status_stream': bench_status_stream(app_module),
+            'frame_path': bench_frame_path(pi_functions, args.repeat),
+        }
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
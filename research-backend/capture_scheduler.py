@@ -0,0 +1,128 @@
+import math
+import threading
+import time
+import uuid
+from metrics import capture_lag
+
+
+class CaptureJob:
+    # Calls tick(job, index) every interval seconds against monotonic deadlines, so request latency
+    # inside tick never shifts the schedule. Ticks missed while a slow tick was running are skipped.
+    # tick returns False to end the job early.
+
+    def __init__(self, tick, interval, count=None, job_id=None):
+        self.id = job_id or uuid.uuid4().hex[:8]
+        self.tick = tick
+        self.interval = interval
+        self.count = count
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f"capture-{self.id}", daemon=True)
+        self.state = 'pending'
+        self.captures = 0
+        self.skipped = 0
+        self.max_lag = 0.0
+        self.last_error = None
+        self.started_at = None
+        self.first_capture_at = None
+        self.last_capture_at = None
+        self.finished_at = None
+
+    def start(self):
+        self.state = 'running'
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def run(self):
+        self.started_at = time.monotonic()
+        deadline = self.started_at
+        index = 0
+
+        while not self.stopping.is_set():
+            if self.stopping.wait(max(0.0, deadline - time.monotonic())):
+                break
+
+            lag = time.monotonic() - deadline
+            self.max_lag = max(self.max_lag, lag)
+            capture_lag.observe(lag)
+            try:
+                keep_going = self.tick(self, index)
+            except Exception as e:
+                print(f"Capture job {self.id} tick {index} failed: {e}")
+                self.last_error = str(e)
+                keep_going = True
+            self.captures += 1
+            self.last_capture_at = time.monotonic()
+            if self.first_capture_at is None:
+                self.first_capture_at = self.last_capture_at
+            index += 1
+
+            if keep_going is False or (self.count is not None and index >= self.count):
+                break
+
+            deadline += self.interval
+            now = time.monotonic()
+            if deadline < now:
+                missed = math.ceil((now - deadline) / self.interval)
+                self.skipped += missed
+                index += missed
+                deadline += missed * self.interval
+                if self.count is not None and index >= self.count:
+                    break  # The skipped ticks used up the rest of the job's duration
+
+        self.finished_at = time.monotonic()
+        self.state = 'stopped' if self.stopping.is_set() else 'finished'
+
+    def status(self):
+        elapsed = self.last_capture_at - self.first_capture_at if self.captures > 1 else 0
+        status = {
+            'job_id': self.id,
+            'state': self.state,
+            'captures': self.captures,
+            'skipped': self.skipped,
+            'target_per_minute': round(60 / self.interval, 3),
+            # captures - 1 intervals have elapsed between the first and the latest capture
+            'actual_per_minute': round((self.captures - 1) * 60 / elapsed, 3) if elapsed else 0.0,
+            'max_lag_ms': round(self.max_lag * 1000, 2),
+            'last_error': self.last_error,
+        }
+        if hasattr(self.tick, 'stats'):
+            status.update(self.tick.stats())
+        return status
+
+
+class CaptureScheduler:
+    def __init__(self, history=50):
+        self.jobs = {}
+        self.history = history  # Finished/stopped jobs kept for /status; older ones are forgotten
+        self.lock = threading.Lock()
+
+    def start(self, tick, interval, count=None):
+        job = CaptureJob(tick, interval, count)
+        with self.lock:
+            self.prune()
+            self.jobs[job.id] = job
+        job.start()
+        return job.id
+
+    def prune(self):
+        # Called with the lock held. Jobs are in start order, so the oldest ended ones go first
+        ended = [job_id for job_id, job in self.jobs.items() if job.finished_at is not None]
+        for job_id in ended[:max(0, len(ended) - self.history)]:
+            del self.jobs[job_id]
+
+    def stop(self, job_id=None):
+        # Stops one job, or every job when job_id is None. Returns the ids that were stopped
+        with self.lock:
+            jobs = [self.jobs[job_id]] if job_id in self.jobs else (list(self.jobs.values()) if job_id is None else [])
+        for job in jobs:
+            job.stop()
+        return [job.id for job in jobs]
+
+    def status(self, job_id=None):
+        with self.lock:
+            if job_id is not None:
+                job = self.jobs.get(job_id)
+                return job.status() if job else None
+            return [job.status() for job in self.jobs.values()]
@@ -0,0 +1,80 @@
+from PIL import Image
+from io import BytesIO
+import numpy as np
+import os
+import threading
+import time
+
+HASH_SIZE = 8
+# Shared by every capture path (Pi capture jobs and fleet_poller.py) so they skip the same frames
+CHANGE_THRESHOLD = int(os.getenv('CHANGE_THRESHOLD', '4'))  # Hash bits that may differ before a frame counts as changed
+FORCE_INFERENCE_EVERY = int(os.getenv('FORCE_INFERENCE_EVERY', '10'))
+
+
+def frame_hash(image, shape=None):
+    # 64-bit difference hash of a tiny grayscale copy of the frame.
+    # Accepts encoded bytes, raw bytes with a shape, a PIL image or a numpy array
+    if isinstance(image, (bytes, bytearray, memoryview)) and shape is not None:
+        image = np.frombuffer(image, dtype=np.uint8).reshape(shape)
+
+    if isinstance(image, np.ndarray):
+        gray = Image.fromarray(image[..., :3].mean(axis=2).astype(np.uint8))
+    elif isinstance(image, Image.Image):
+        gray = image.convert('L')
+    else:
+        gray = Image.open(BytesIO(image))
+        gray.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))  # JPEGs decode straight at 1/8 scale
+        gray = gray.convert('L')
+
+    pixels = np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    return (pixels[:, 1:] > pixels[:, :-1]).flatten()
+
+
+class ChangeGate:
+    # Reuses the last classification while frames stay visually the same.
+    # A frame is re-classified when its hash differs from the last classified frame by more than
+    # threshold bits, or after force_every consecutive reused results.
+
+    def __init__(self, threshold=CHANGE_THRESHOLD, force_every=FORCE_INFERENCE_EVERY):
+        self.threshold = threshold
+        self.force_every = force_every
+        self.lock = threading.Lock()
+        self.last_hash = None
+        self.last_result = None
+        self.reused_in_a_row = 0
+        self.frames = 0
+        self.skipped = 0
+        self.classify_time = 0.0
+        self.classified = 0
+
+    def classify(self, image, classify_fn, shape=None):
+        current = frame_hash(image, shape=shape)
+
+        with self.lock:
+            self.frames += 1
+            if (self.last_hash is not None and self.reused_in_a_row < self.force_every
+                    and np.count_nonzero(current != self.last_hash) <= self.threshold):
+                self.reused_in_a_row += 1
+                self.skipped += 1
+                return self.last_result
+
+        start = time.perf_counter()
+        result = classify_fn(image)
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            self.last_hash = current
+            self.last_result = result
+            self.reused_in_a_row = 0
+            self.classified += 1
+            self.classify_time += elapsed
+        return result
+
+    def stats(self):
+        mean_classify = self.classify_time / self.classified if self.classified else 0.0
+        return {
+            'frames': self.frames,
+            'skipped': self.skipped,
+            'skip_rate': round(self.skipped / self.frames, 4) if self.frames else 0.0,
+            'compute_saved_ms': round(self.skipped * mean_classify * 1000, 2),
+        }
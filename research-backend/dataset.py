@@ -0,0 +1,248 @@
+#Builds the training set once into memory-mappable shards so training and evaluation don't re-decode JPEGs every epoch.
+#Usage:
+#  python dataset.py build "ML/data/Machine Learning Sets" ML/dataset [--workers N] [--shard-size 256] [--rebuild]
+#  python dataset.py info ML/dataset
+#Output: shard_XXXXX.npy (N x 480 x 640 x 3 uint8, RGB), index.npz (shard, row, label per image) and manifest.json.
+#Rebuilds are incremental: files whose size/mtime are unchanged are skipped, changed ones are re-hashed and only
+#re-decoded if their content changed, and new images go into new shards.
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from PIL import Image
+from preprocessing import MODEL_HEIGHT, MODEL_WIDTH
+
+CLASSES = ['clean', 'dirty', 'empty']  # Same order as ml_scripts.label_for
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp')
+MANIFEST_VERSION = 1
+
+
+def label_for_folder(name):
+    #Top-level folders of the raw "Machine Learning Sets" tree (the rules ML/helpers.py used), or
+    #an already sorted clean/ dirty/ empty/ tree
+    lowered = name.lower()
+    if lowered in CLASSES:
+        return CLASSES.index(lowered)
+    if "No Water" in name:
+        return CLASSES.index('empty')
+    if any(word in name for word in ("Tap", "Fertilizer", "Algae", "Dust")):
+        return CLASSES.index('clean')
+    return CLASSES.index('dirty')
+
+
+def list_sources(source):
+    #Returns {relative path: label} for every image under source, at any depth below its class folder
+    sources = {}
+    for folder in sorted(os.listdir(source)):
+        folder_path = os.path.join(source, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        label = label_for_folder(folder)
+        for root, _, files in os.walk(folder_path):
+            for name in files:
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    sources[os.path.relpath(os.path.join(root, name), source)] = label
+    return sources
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def decode_into(task):
+    #Runs in a worker process: decodes and resizes one image straight into its row of the shard on disk
+    path, shard_path, row = task
+    try:
+        with Image.open(path) as image:
+            image.draft('RGB', (MODEL_WIDTH, MODEL_HEIGHT))  # JPEGs decode at a reduced scale that's still >= target
+            image = image.convert('RGB')
+            if image.size != (MODEL_WIDTH, MODEL_HEIGHT):
+                image = image.resize((MODEL_WIDTH, MODEL_HEIGHT), Image.BILINEAR)
+            shard = np.load(shard_path, mmap_mode='r+')
+            shard[row] = np.asarray(image)
+            shard.flush()
+        return row, None
+    except Exception as e:
+        return row, str(e)
+
+
+def write_json(path, data):
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_manifest(output):
+    path = os.path.join(output, 'manifest.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('shape') != [MODEL_HEIGHT, MODEL_WIDTH, 3]:
+        return None  # Built with a different layout, start over
+    return manifest
+
+
+def write_index(output, manifest):
+    #The index lists live rows only, sorted by source path so it is stable across rebuilds
+    entries = sorted(manifest['files'].items())
+    np.savez(os.path.join(output, 'index.npz'),
+             shard=np.array([entry['shard'] for _, entry in entries], dtype=np.int32),
+             row=np.array([entry['row'] for _, entry in entries], dtype=np.int32),
+             label=np.array([entry['label'] for _, entry in entries], dtype=np.int64),
+             path=np.array([path for path, _ in entries]))
+
+
+def build(source, output, workers=None, shard_size=256, rebuild=False):
+    start = time.perf_counter()
+    os.makedirs(output, exist_ok=True)
+    manifest = None if rebuild else load_manifest(output)
+    if manifest is None:
+        for name in os.listdir(output):
+            if name.startswith('shard_') and name.endswith('.npy'):
+                os.remove(os.path.join(output, name))
+        manifest = {'version': MANIFEST_VERSION, 'shape': [MODEL_HEIGHT, MODEL_WIDTH, 3], 'classes': CLASSES,
+                    'shards': [], 'files': {}, 'failed': {}}
+    files, failed_files = manifest['files'], manifest['failed']
+    sources = list_sources(source)
+
+    removed = [path for path in files if path not in sources]
+    for path in removed:
+        del files[path]
+
+    #Only files whose size or mtime moved need hashing, and only new content needs decoding.
+    #Files that failed to decode are retried once they change
+    stats = {path: os.stat(os.path.join(source, path)) for path in sources}
+
+    def unchanged(entry, path):
+        return entry is not None and entry['size'] == stats[path].st_size and entry['mtime_ns'] == stats[path].st_mtime_ns
+
+    suspects = [path for path in sources if not unchanged(files.get(path), path) and not unchanged(failed_files.get(path), path)]
+    for path in list(failed_files):
+        if path not in sources or path in suspects:
+            del failed_files[path]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        digests = dict(zip(suspects, pool.map(file_digest, [os.path.join(source, path) for path in suspects], chunksize=16)))
+
+        todo = []
+        for path in suspects:
+            entry = files.get(path)
+            if entry is not None and entry['sha256'] == digests[path] and entry['label'] == sources[path]:
+                entry.update(size=stats[path].st_size, mtime_ns=stats[path].st_mtime_ns)  # Touched, not changed
+            else:
+                files.pop(path, None)
+                todo.append(path)
+
+        failed = 0
+        for offset in range(0, len(todo), shard_size):
+            batch = todo[offset:offset + shard_size]
+            shard_id = len(manifest['shards'])
+            shard_name = f"shard_{shard_id:05d}.npy"
+            shard_path = os.path.join(output, shard_name)
+            np.lib.format.open_memmap(shard_path, mode='w+', dtype=np.uint8, shape=(len(batch), MODEL_HEIGHT, MODEL_WIDTH, 3)).flush()
+
+            tasks = [(os.path.join(source, path), shard_path, row) for row, path in enumerate(batch)]
+            for row, error in pool.map(decode_into, tasks, chunksize=4):
+                path = batch[row]
+                if error:
+                    failed += 1
+                    failed_files[path] = {'size': stats[path].st_size, 'mtime_ns': stats[path].st_mtime_ns, 'error': error}
+                    print(f"Skipping {path}: {error}")
+                    continue
+                files[path] = {'label': sources[path], 'sha256': digests[path], 'size': stats[path].st_size,
+                               'mtime_ns': stats[path].st_mtime_ns, 'shard': shard_id, 'row': row}
+
+            manifest['shards'].append({'name': shard_name, 'rows': len(batch)})
+            #Saved after every shard so an interrupted build resumes from here
+            write_json(os.path.join(output, 'manifest.json'), manifest)
+            print(f"Wrote {shard_name} ({len(batch)} images)")
+
+    write_json(os.path.join(output, 'manifest.json'), manifest)
+    write_index(output, manifest)
+
+    stale = sum(shard['rows'] for shard in manifest['shards']) - len(files)
+    if stale:
+        print(f"{stale} rows in the shards belong to changed or removed files; use --rebuild to compact")
+    return {
+        'images': len(files),
+        'decoded': len(todo) - failed,
+        'failed': failed,
+        'unchanged': len(sources) - len(todo),
+        'skipped_unreadable': len(failed_files),
+        'removed': len(removed),
+        'shards': len(manifest['shards']),
+        'per_class': {name: sum(entry['label'] == i for entry in files.values()) for i, name in enumerate(CLASSES)},
+        'seconds': round(time.perf_counter() - start, 2),
+    }
+
+
+class ShardedImageDataset(torch.utils.data.Dataset):
+    #Reads a built dataset through memory maps. Items are (uint8 HxWx3 RGB tensor, label);
+    #converting to float CHW is left to the caller so it can be done a whole batch at a time.
+    #Shards are opened lazily, so each DataLoader worker maps them itself after it starts.
+
+    def __init__(self, root, indices=None):
+        self.root = root
+        with open(os.path.join(root, 'manifest.json')) as f:
+            manifest = json.load(f)
+        self.classes = manifest['classes']
+        self.shard_names = [shard['name'] for shard in manifest['shards']]
+        index = np.load(os.path.join(root, 'index.npz'))
+        self.shards_idx, self.rows, self.labels = index['shard'], index['row'], index['label']
+        self.paths = index['path']
+        self.indices = np.arange(len(self.labels)) if indices is None else np.asarray(indices)
+        self.shards = {}
+
+    def __len__(self):
+        return len(self.indices)
+
+    def shard(self, shard_id):
+        if shard_id not in self.shards:
+            self.shards[shard_id] = np.load(os.path.join(self.root, self.shard_names[shard_id]), mmap_mode='r')
+        return self.shards[shard_id]
+
+    def __getitem__(self, i):
+        i = self.indices[i]
+        frame = self.shard(int(self.shards_idx[i]))[self.rows[i]]
+        return torch.from_numpy(np.array(frame)), int(self.labels[i])
+
+    def subset(self, indices):
+        return ShardedImageDataset(self.root, self.indices[np.asarray(indices)])
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['shards'] = {}  # Memory maps aren't sent to worker processes
+        return state
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = commands.add_parser('build')
+    build_parser.add_argument('source', help='raw image tree, one folder per set (e.g. "Machine Learning Sets") or clean/ dirty/ empty/')
+    build_parser.add_argument('output')
+    build_parser.add_argument('--workers', type=int, default=None, help='decode processes (default: all cores)')
+    build_parser.add_argument('--shard-size', type=int, default=256, help='images per shard (~0.9 MB per image, so ~236 MB for 256)')
+    build_parser.add_argument('--rebuild', action='store_true', help='ignore the manifest and rebuild from scratch')
+
+    info_parser = commands.add_parser('info')
+    info_parser.add_argument('output')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        print(json.dumps(build(args.source, args.output, workers=args.workers, shard_size=args.shard_size, rebuild=args.rebuild), indent=2))
+    else:
+        dataset = ShardedImageDataset(args.output)
+        counts = np.bincount(dataset.labels, minlength=len(dataset.classes))
+        print(json.dumps({'images': len(dataset), 'shards': len(dataset.shard_names),
+                          'per_class': dict(zip(dataset.classes, counts.tolist()))}, indent=2))
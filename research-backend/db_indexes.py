@@ -0,0 +1,132 @@
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo.errors import CollectionInvalid, DuplicateKeyError, OperationFailure
+from datetime import datetime
+import sys
+from status_events import STATUS_EVENTS_BYTES, STATUS_EVENTS_COLLECTION
+
+# Collections that have to be created with options before any index touches them
+TIMESERIES = {
+    'readings': {'timeField': 'timestamp', 'metaField': 'system_id', 'granularity': 'minutes'},
+}
+CAPPED = {
+    STATUS_EVENTS_COLLECTION: STATUS_EVENTS_BYTES,  # Tailed by status_stream.py, so it must be capped
+}
+
+# Every index the routes rely on, per collection: (keys, options)
+INDEXES = {
+    'users': [
+        ([('username', ASCENDING)], {'unique': True}),
+        ([('email', ASCENDING)], {}),
+    ],
+    'systems': [
+        ([('username', ASCENDING), ('name', ASCENDING)], {'unique': True}),
+        ([('camera_url', ASCENDING)], {'sparse': True}),
+    ],
+    'reset_codes': [
+        ([('email', ASCENDING), ('code', ASCENDING), ('used', ASCENDING), ('expires_at', ASCENDING)], {}),
+        ([('expires_at', ASCENDING)], {'expireAfterSeconds': 0}),  # Mongo deletes codes once they expire
+    ],
+    'readings': [
+        ([('system_id', ASCENDING), ('timestamp', ASCENDING)], {}),
+    ],
+    'reading_rollups': [
+        ([('system_id', ASCENDING), ('granularity', ASCENDING), ('bucket', ASCENDING)], {'unique': True}),
+    ],
+    'alert_outbox': [
+        ([('status', ASCENDING), ('created_at', ASCENDING)], {}),
+        ([('system_id', ASCENDING), ('state', ASCENDING), ('created_at', DESCENDING)], {}),
+    ],
+}
+
+# The query each route issues, with placeholder values, for the explain() audit
+ROUTE_QUERIES = [
+    ('add_system', 'systems', {'name': 'tank', 'username': 'user'}),
+    ('get_systems', 'systems', {'username': 'user'}),
+    ('get_systems_data', 'systems', {'username': 'user'}),
+    ('get_systems_data_page', 'systems', {'username': 'user', 'name': {'$gt': 'tank'}}),
+    ('signup', 'users', {'username': 'user'}),
+    ('authenticate', 'users', {'username': 'user', 'password': 'password'}),
+    ('forgot_password', 'users', {'email': 'user@example.com'}),
+    ('verify_reset_code', 'reset_codes', {'email': 'user@example.com', 'code': '123456', 'used': False, 'expires_at': {'$gt': datetime.utcnow()}}),
+    ('reset_password', 'users', {'email': 'user@example.com'}),
+    ('profile', 'users', {'username': 'user'}),
+    ('delete_all_systems', 'systems', {'username': 'user'}),
+    ('serve_profile_photo', 'users', {'username': 'user'}),
+    ('fleet_poller', 'systems', {'camera_url': {'$exists': True}}),
+    ('system_readings', 'readings', {'system_id': 'system', 'timestamp': {'$gte': datetime.utcnow()}}),
+    ('system_history', 'reading_rollups', {'system_id': 'system', 'granularity': 'day', 'bucket': {'$gte': datetime.utcnow()}}),
+    ('alert_cooldown', 'alert_outbox', {'system_id': 'system', 'state': 'dirty', 'created_at': {'$gt': datetime.utcnow()}}),
+    ('alert_flush', 'alert_outbox', {'status': 'pending', 'created_at': {'$lte': datetime.utcnow()}}),
+    ('alert_recover', 'alert_outbox', {'status': 'sending', 'claimed_at': {'$lte': datetime.utcnow()}}),
+]
+
+
+def ensure_collections(db):
+    for collection, options in TIMESERIES.items():
+        try:
+            db.create_collection(collection, timeseries=options)
+        except CollectionInvalid:
+            pass  # Already exists
+        except (OperationFailure, NotImplementedError) as e:  # Older servers, or mongomock as a local stand-in
+            print(f"Time-series collections unavailable, using a regular '{collection}' collection: {e}")
+    for collection, size in CAPPED.items():
+        try:
+            db.create_collection(collection, capped=True, size=size)
+        except CollectionInvalid:
+            pass
+        except (OperationFailure, NotImplementedError) as e:
+            print(f"Capped collections unavailable, status streams will poll a regular '{collection}' collection: {e}")
+
+
+def duplicates(col, keys, limit=5):
+    # Sample of key values held by more than one document, which block a unique index
+    group = {'_id': {field: f'${field}' for field, _ in keys}, 'count': {'$sum': 1}}
+    return [(dup['_id'], dup['count']) for dup in
+            col.aggregate([{'$group': group}, {'$match': {'count': {'$gt': 1}}}, {'$limit': limit}])]
+
+
+def ensure_indexes(db):
+    # A unique index can't be built over existing duplicates (older versions didn't prevent them);
+    # that is reported and the server still starts, without the index, until they are cleaned up
+    ensure_collections(db)
+    for collection, indexes in INDEXES.items():
+        for keys, options in indexes:
+            try:
+                db[collection].create_index(keys, **options)
+            except DuplicateKeyError:
+                fields = ', '.join(field for field, _ in keys)
+                print(f"Unique index on {collection}({fields}) not created, these values are duplicated: "
+                      f"{duplicates(db[collection], keys)}. Remove the duplicates and restart to enforce it")
+
+
+def plan_stages(plan):
+    yield plan.get('stage')
+    for child in plan.get('inputStages', []) + [plan[key] for key in ('inputStage', 'queryPlan') if key in plan]:
+        yield from plan_stages(child)
+
+
+def audit(db):
+    # Returns the routes whose query would scan the whole collection
+    failures = []
+    for route, collection, query in ROUTE_QUERIES:
+        explain = db[collection].find(query).explain()
+        if 'queryPlanner' not in explain:
+            explain = explain['stages'][0]['$cursor']  # Time-series finds are explained as an aggregation
+        plan = explain['queryPlanner']['winningPlan']
+        stages = list(plan_stages(plan))
+        print(f"{route:<22} {collection:<14} {' <- '.join(s for s in stages if s)}")
+        if 'COLLSCAN' in stages:
+            failures.append(route)
+    return failures
+
+
+if __name__ == '__main__':
+    db = MongoClient("mongodb://localhost:27017")["mydb"]
+    ensure_indexes(db)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'audit':
+        failures = audit(db)
+        if failures:
+            print(f"COLLSCAN in: {', '.join(failures)}")
+            sys.exit(1)
+        print("All route queries use an index")
@@ -0,0 +1,119 @@
+#Exports the trained weights for CPU/edge inference and compares the backends.
+#Usage:
+#  python export_model.py export [--calibration <image folder>]
+#  python export_model.py report <held-out folder with clean/ dirty/ empty/ subfolders>
+#Pick the runtime backend with INFERENCE_BACKEND=eager|torchscript|int8|onnx
+import argparse
+import copy
+import json
+import os
+import time
+import torch
+from torchvision import transforms
+from PIL import Image
+from ml_scripts import (MODEL_PATH, MODEL_HEIGHT, MODEL_WIDTH, BACKEND_SUFFIXES, InferenceEngine,
+                        artifact_path, load_eager_model, quantized_engine)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp')
+
+
+def list_images(folder):
+    #Returns (path, label) pairs; the label is the name of the image's class folder
+    images = []
+    for label in sorted(os.listdir(folder)):
+        class_dir = os.path.join(folder, label)
+        if os.path.isdir(class_dir):
+            images.extend((os.path.join(class_dir, name), label.capitalize())
+                          for name in sorted(os.listdir(class_dir)) if name.lower().endswith(IMAGE_EXTENSIONS))
+    return images
+
+
+def calibration_batches(folder, batch_size=8, limit=64):
+    tran = transforms.Compose([transforms.Resize((MODEL_HEIGHT, MODEL_WIDTH)), transforms.ToTensor()])
+    images = [path for path, _ in list_images(folder)][:limit]
+    for i in range(0, len(images), batch_size):
+        yield torch.stack([tran(Image.open(path).convert("RGB")) for path in images[i:i+batch_size]])
+
+
+def export(model_path, calibration=None):
+    model = load_eager_model(model_path)
+    example = torch.zeros(1, 3, MODEL_HEIGHT, MODEL_WIDTH)
+    with torch.inference_mode():
+        model(example)#materialize the LazyLinear head before tracing
+
+    with torch.no_grad():
+        torch.jit.save(torch.jit.trace(model, example), artifact_path(model_path, 'torchscript'))
+        print(f"Wrote {artifact_path(model_path, 'torchscript')}")
+
+        torch.onnx.export(model, example, artifact_path(model_path, 'onnx'), input_names=['images'], output_names=['scores'],
+                          dynamic_axes={'images': {0: 'batch'}, 'scores': {0: 'batch'}}, opset_version=17)
+        print(f"Wrote {artifact_path(model_path, 'onnx')}")
+
+        torch.backends.quantized.engine = quantized_engine()
+        if calibration:
+            #Static int8: convs and the head are quantized, activation ranges come from calibration images
+            from torch.ao.quantization import get_default_qconfig_mapping
+            from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+            prepared = prepare_fx(copy.deepcopy(model), get_default_qconfig_mapping(torch.backends.quantized.engine), example_inputs=(example,))
+            for batch in calibration_batches(calibration):
+                prepared(batch)
+            quantized = convert_fx(prepared)
+        else:
+            #Dynamic int8: only the (very large) Linear head is quantized, no calibration data needed
+            quantized = torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {torch.nn.Linear}, dtype=torch.qint8)
+
+        torch.jit.save(torch.jit.trace(quantized, example), artifact_path(model_path, 'int8'))
+        print(f"Wrote {artifact_path(model_path, 'int8')} ({'static' if calibration else 'dynamic'} quantization)")
+
+
+def report(model_path, folder, batch_size):
+    images = list_images(folder)
+    if not images:
+        raise SystemExit(f"No images found under {folder}")
+
+    results = []
+    for backend in BACKEND_SUFFIXES:
+        if not os.path.exists(artifact_path(model_path, backend)):
+            print(f"Skipping {backend}: {artifact_path(model_path, backend)} not found, run export first")
+            continue
+
+        engine = InferenceEngine(model_path, backend=backend)
+        correct = 0
+        start = time.perf_counter()
+        for i in range(0, len(images), batch_size):
+            chunk = images[i:i+batch_size]
+            predictions = engine.predict_batch([Image.open(path) for path, _ in chunk], max_batch_size=batch_size)
+            correct += sum(label == expected for (label, _), (_, expected) in zip(predictions, chunk))
+        elapsed = time.perf_counter() - start
+
+        results.append({
+            'backend': backend,
+            'artifact_mb': round(os.path.getsize(engine.model_path) / 2**20, 2),
+            'accuracy': round(correct / len(images), 4),
+            'images_per_sec': round(len(images) / elapsed, 2),
+            'mean_forward_ms': engine.stats()['mean_latency_ms'],
+            'load_time_ms': engine.stats()['load_time_ms'],
+        })
+
+    print(json.dumps(results, indent=2))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default=MODEL_PATH)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export')
+    export_parser.add_argument('--calibration', help='image folder for static int8 calibration (dynamic quantization if omitted)')
+
+    report_parser = commands.add_parser('report')
+    report_parser.add_argument('folder')
+    report_parser.add_argument('--batch-size', type=int, default=8)
+
+    args = parser.parse_args()
+    if args.command == 'export':
+        export(args.model, args.calibration)
+    else:
+        report(args.model, args.folder, args.batch_size)
@@ -0,0 +1,129 @@
+#Polls every Pi camera registered in the systems collection concurrently and feeds frames into inference.
+#Usage: python fleet_poller.py
+import aiohttp
+import asyncio
+import random
+import time
+from datetime import datetime
+from ml_scripts import classify_image_bytes
+from system_status import store_latest_status
+from status_events import publish_change
+from change_detection import ChangeGate, CHANGE_THRESHOLD, FORCE_INFERENCE_EVERY
+
+CAMERA_PROJECTION = {'name': 1, 'username': 1, 'camera_url': 1, 'poll_interval': 1}
+
+
+class FleetPoller:
+    def __init__(self, systems_col, on_status=None, reading_store=None, events_col=None, concurrency=16, per_host=2, timeout=10.0, retries=3,
+                 backoff=0.5, default_interval=60.0, refresh_interval=60.0):
+        self.systems_col = systems_col
+        self.on_status = on_status  # Called with (system before update, new status), e.g. the alert dispatcher
+        self.reading_store = reading_store
+        self.events_col = events_col  # Status changes for dashboards (see status_stream.py)
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.default_interval = default_interval
+        self.refresh_interval = refresh_interval
+        self.tasks = {}
+        self.camera_stats = {}
+        self.gates = {}
+        self.stopping = asyncio.Event()
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host, keepalive_timeout=120)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=self.timeout) as session:
+            while not self.stopping.is_set():
+                await self.refresh(session, semaphore)
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), timeout=self.refresh_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            for task in self.tasks.values():
+                task.cancel()
+            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+    def stop(self):
+        self.stopping.set()
+
+    async def refresh(self, session, semaphore):
+        #Picks up cameras added or removed in Mongo since the last refresh
+        systems = await asyncio.to_thread(
+            lambda: list(self.systems_col.find({'camera_url': {'$exists': True}}, CAMERA_PROJECTION))
+        )
+        current = {str(system['_id']): system for system in systems}
+
+        for system_id in list(self.tasks):
+            if system_id not in current:
+                self.tasks.pop(system_id).cancel()
+
+        for system_id, system in current.items():
+            if system_id not in self.tasks or self.tasks[system_id].done():
+                self.tasks[system_id] = asyncio.create_task(self.poll_camera(session, semaphore, system))
+
+    async def poll_camera(self, session, semaphore, system):
+        system_id = str(system['_id'])
+        interval = float(system.get('poll_interval') or self.default_interval)
+        stats = self.camera_stats.setdefault(system_id, {'name': system['name'], 'polls': 0, 'failures': 0, 'last_latency_ms': None})
+        gate = self.gates.setdefault(system_id, ChangeGate(threshold=CHANGE_THRESHOLD, force_every=FORCE_INFERENCE_EVERY))
+
+        #Spread the first polls out so every camera isn't hit at once
+        deadline = time.monotonic() + random.uniform(0, interval)
+        while not self.stopping.is_set():
+            await asyncio.sleep(max(0.0, deadline - time.monotonic()))
+
+            start = time.perf_counter()
+            try:
+                frame = await self.fetch(session, semaphore, system['camera_url'])
+                captured_at = datetime.utcnow()
+                label, confidence = await asyncio.to_thread(gate.classify, frame, lambda data: classify_image_bytes([data])[0])
+                before = await asyncio.to_thread(store_latest_status, self.systems_col, system_id, label, confidence, captured_at)
+                if before and self.reading_store:
+                    await asyncio.to_thread(self.reading_store.add, system_id, label, confidence, captured_at, frame)
+                if before and self.on_status:
+                    await asyncio.to_thread(self.on_status, before, label.lower())
+                if before and self.events_col is not None:
+                    await asyncio.to_thread(publish_change, self.events_col, before, label, confidence, captured_at)
+                stats['polls'] += 1
+            except Exception as e:
+                print(f"Polling {system['name']} failed: {e}")
+                stats['failures'] += 1
+            stats['last_latency_ms'] = round((time.perf_counter() - start) * 1000, 2)
+
+            #Next tick on the fixed schedule; skip ticks that were missed instead of catching up
+            deadline += interval
+            now = time.monotonic()
+            if deadline < now:
+                deadline += ((now - deadline) // interval + 1) * interval
+
+    async def fetch(self, session, semaphore, camera_url):
+        url = f"{camera_url.rstrip('/')}/get_frame"
+        for attempt in range(self.retries + 1):
+            try:
+                async with semaphore:
+                    async with session.get(url, params={'format': 'jpeg'}) as response:
+                        response.raise_for_status()
+                        return await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def stats(self):
+        return {
+            'cameras': len(self.tasks),
+            'per_camera': {system_id: {**stats, 'change_gate': self.gates[system_id].stats()} for system_id, stats in self.camera_stats.items()}
+        }
+
+
+if __name__ == '__main__':
+    import app
+
+    app.init_worker()  # Mongo, readings store, alert dispatcher and inference for this process
+    asyncio.run(FleetPoller(app.systems_col, on_status=app.alert_dispatcher.notify_status, reading_store=app.reading_store,
+                            events_col=app.status_events_col).run())
@@ -0,0 +1,54 @@
+#Compares the Pi's frame transports: base64 PNG in JSON (/get_images) vs binary JPEG / raw (/get_frame)
+#Usage: python frame_transport_benchmark.py http://<pi-ip>:5000 [frames]
+import requests
+import json
+import sys
+import time
+from raspberry_pi_functions import decode_image, decode_frame
+
+
+def run(name, fetch, decode, frames):
+    session = requests.Session()
+    total_bytes = 0
+    decode_time = 0.0
+
+    start = time.perf_counter()
+    for _ in range(frames):
+        response = fetch(session)
+        response.raise_for_status()
+        total_bytes += len(response.content)
+
+        decode_start = time.perf_counter()
+        decode(response).load()
+        decode_time += time.perf_counter() - decode_start
+    elapsed = time.perf_counter() - start
+
+    return {
+        'transport': name,
+        'frames': frames,
+        'bytes_per_frame': total_bytes // frames,
+        'fps': round(frames / elapsed, 2),
+        'decode_ms_per_frame': round(decode_time / frames * 1000, 2),
+    }
+
+
+if __name__ == '__main__':
+    base_url = sys.argv[1].rstrip('/')
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    results = [
+        run('base64-png-json',
+            lambda s: s.post(f"{base_url}/get_images", json={}),
+            lambda r: decode_image(r.json()['image']),
+            frames),
+        run('binary-jpeg',
+            lambda s: s.get(f"{base_url}/get_frame", params={'format': 'jpeg'}),
+            decode_frame,
+            frames),
+        run('binary-raw',
+            lambda s: s.get(f"{base_url}/get_frame", params={'format': 'raw'}),
+            decode_frame,
+            frames),
+    ]
+
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,31 @@
+#Production serving: gunicorn -c gunicorn.conf.py
+#WEB_CONCURRENCY worker processes, each with GUNICORN_THREADS request threads. The master loads the model
+#once (preload_app) and the workers share those pages copy-on-write; Mongo pools, the micro-batcher and the
+#background threads are created per worker in post_fork.
+#Dashboard status streams are long-lived, so they are served by status_stream.py rather than these threads.
+import gc
+import multiprocessing
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_CONCURRENCY', str(multiprocessing.cpu_count())))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+worker_class = 'gthread'
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+keepalive = 5
+
+wsgi_app = 'app:create_app(init=False)'
+preload_app = True
+
+
+def when_ready(server):
+    #Keep the preloaded objects out of the cyclic GC so collections in the workers don't touch
+    #(and copy) their pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import app
+    #Split the cores between workers so torch's intra-op threads don't oversubscribe the machine
+    torch_threads = int(os.getenv('TORCH_THREADS', '0')) or max(1, multiprocessing.cpu_count() // server.cfg.workers)
+    app.init_worker(torch_threads=torch_threads)
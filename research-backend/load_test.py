@@ -0,0 +1,141 @@
+#Load test for the production server: starts gunicorn with 1, 2, 4... workers and measures requests/sec.
+#Needs MongoDB at MONGO_URI and gunicorn installed. Seeds a throwaway user's systems and removes them afterwards.
+#Usage: python load_test.py [--workers 1,2,4] [--endpoint dashboard|ingest] [--concurrency 32] [--duration 15]
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from io import BytesIO
+import aiohttp
+import numpy as np
+from PIL import Image
+
+USERNAME = 'load_test'
+
+
+def test_jpeg():
+    rng = np.random.default_rng(0)
+    buffer = BytesIO()
+    Image.fromarray(rng.integers(0, 256, (480, 640, 3), dtype=np.uint8)).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def start_server(workers, threads, port):
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers), GUNICORN_THREADS=str(threads), BIND=f"127.0.0.1:{port}")
+    return subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+
+
+async def wait_ready(session, base_url, server, timeout=180):
+    #Workers load Mongo and warm the model before accepting requests
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {server.returncode}")
+        try:
+            async with session.get(f"{base_url}/metrics") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError("Server did not become ready")
+
+
+async def seed(session, base_url, systems):
+    for i in range(systems):
+        async with session.post(f"{base_url}/add_system", json={'system_name': f"load_{i:03d}", 'username': USERNAME}) as response:
+            await response.read()
+    async with session.get(f"{base_url}/get_systems_data", params={'username': USERNAME}) as response:
+        return [system['id'] for system in await response.json()]
+
+
+async def run_load(session, base_url, endpoint, system_ids, concurrency, duration):
+    image = test_jpeg()
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    def request(i):
+        if endpoint == 'dashboard':
+            return session.get(f"{base_url}/get_systems_data", params={'username': USERNAME})
+        form = aiohttp.FormData()
+        form.add_field('system_id', system_ids[i % len(system_ids)])
+        form.add_field('image', image, filename='frame.jpg', content_type='image/jpeg')
+        return session.post(f"{base_url}/ingest_image", data=form)
+
+    async def client(worker_id):
+        nonlocal errors
+        i = worker_id
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                async with request(i) as response:
+                    await response.read()
+                    if response.status != 200:
+                        errors += 1
+                        continue
+            except aiohttp.ClientError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            i += concurrency
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'requests_per_sec': round(len(latencies) / elapsed, 2),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+        'p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 2) if latencies else None,
+    }
+
+
+async def main(args):
+    results = []
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60)) as session:
+        for workers in [int(n) for n in args.workers.split(',')]:
+            base_url = f"http://127.0.0.1:{args.port}"
+            server = start_server(workers, args.threads, args.port)
+            try:
+                await wait_ready(session, base_url, server)
+                system_ids = await seed(session, base_url, args.systems)
+                result = await run_load(session, base_url, args.endpoint, system_ids, args.concurrency, args.duration)
+                async with session.post(f"{base_url}/delete_all_systems", json={'username': USERNAME}) as response:
+                    await response.read()
+            finally:
+                server.terminate()
+                server.wait()
+
+            result = {'workers': workers, 'threads': args.threads, **result}
+            result['speedup'] = round(result['requests_per_sec'] / results[0]['requests_per_sec'], 2) if results and results[0]['requests_per_sec'] else 1.0
+            results.append(result)
+            print(f"{workers} worker(s): {result['requests_per_sec']} req/s, p50 {result['p50_ms']} ms, "
+                  f"p95 {result['p95_ms']} ms, {result['errors']} errors, {result['speedup']}x")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default='1,2,4')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--endpoint', choices=('dashboard', 'ingest'), default='dashboard')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=15)
+    parser.add_argument('--systems', type=int, default=20)
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    results = asyncio.run(main(args))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,187 @@
+from contextlib import contextmanager
+from pymongo import monitoring
+import bisect
+import threading
+import time
+
+# Minimal Prometheus-style metrics and per-request span tracing shared by the Flask apps.
+# Everything is in-process; /metrics renders the text exposition format.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{str(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self.lock:
+            counts, total = self.series.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.series[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), key + (le,))} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    # Value is read from a callback at scrape time
+    def __init__(self, name, help, callback):
+        self.name = name
+        self.help = help
+        self.callback = callback
+
+    def render(self):
+        try:
+            value = self.callback()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        # Re-registering a name returns the existing metric, so modules can be reloaded safely
+        return self.metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+request_duration = REGISTRY.register(Histogram('http_request_duration_seconds', 'HTTP request latency by route', labels=('route', 'method', 'status')))
+stage_duration = REGISTRY.register(Histogram('stage_duration_seconds', 'Time spent per stage (db, preprocess, model, email, ...)', labels=('stage',)))
+mongo_duration = REGISTRY.register(Histogram('mongo_command_duration_seconds', 'MongoDB command latency', labels=('command',)))
+capture_lag = REGISTRY.register(Histogram('capture_lag_seconds', 'How late each capture tick started vs. its deadline'))
+
+
+_trace = threading.local()
+
+
+def current_trace():
+    return getattr(_trace, 'spans', None)
+
+
+def record_span(stage, seconds):
+    stage_duration.observe(seconds, stage=stage)
+    spans = current_trace()
+    if spans is not None:
+        spans.append((stage, seconds))
+
+
+@contextmanager
+def collect_spans():
+    # Gathers the spans recorded on this thread into a new list, for work done on behalf of other
+    # threads' requests (e.g. the inference micro-batcher); the caller hands the list to their traces
+    previous = current_trace()
+    _trace.spans = []
+    try:
+        yield _trace.spans
+    finally:
+        _trace.spans = previous
+
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, time.perf_counter() - start)
+
+
+def gauge(name, help, callback):
+    return REGISTRY.register(Gauge(name, help, callback))
+
+
+class MongoListener(monitoring.CommandListener):
+    # Pymongo calls these on the thread that issued the command, so db time lands in the request's trace
+    def __init__(self):
+        self.pending = {}
+
+    def started(self, event):
+        self.pending[(event.connection_id, event.request_id)] = time.perf_counter()
+
+    def succeeded(self, event):
+        self.finish(event)
+
+    def failed(self, event):
+        self.finish(event)
+
+    def finish(self, event):
+        start = self.pending.pop((event.connection_id, event.request_id), None)
+        if start is not None:
+            seconds = time.perf_counter() - start
+            mongo_duration.observe(seconds, command=event.command_name)
+            record_span('db', seconds)
+
+
+def init_app(app, slow_request_ms=None):
+    # Adds per-route latency histograms, request traces and a /metrics endpoint to a Flask app.
+    # Requests slower than slow_request_ms are logged with their span breakdown
+    from flask import Response, request
+
+    @app.before_request
+    def start_trace():
+        _trace.spans = []
+        _trace.start = time.perf_counter()
+
+    @app.after_request
+    def finish_trace(response):
+        start = getattr(_trace, 'start', None)
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_duration.observe(elapsed, route=route, method=request.method, status=response.status_code)
+
+        if slow_request_ms is not None and elapsed * 1000 >= slow_request_ms:
+            totals = {}
+            for stage, seconds in current_trace() or []:
+                totals[stage] = totals.get(stage, 0.0) + seconds
+            breakdown = ', '.join(f"{stage}={seconds*1000:.1f}ms" for stage, seconds in sorted(totals.items(), key=lambda item: -item[1]))
+            print(f"Slow request {request.method} {route} took {elapsed*1000:.1f}ms: {breakdown or 'no spans'}")
+
+        return response
+
+    @app.teardown_request
+    def clear_trace(error=None):
+        _trace.spans = None
+        _trace.start = None
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+    return app
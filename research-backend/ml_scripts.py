@@ -1,7 +1,16 @@
 from PIL import Image
+from collections import OrderedDict
+import hashlib
+import os
+import platform
+import queue
+import threading
+import time
 import torch
-from torchvision import transforms
 from torch import nn
+from concurrent.futures import Future
+from preprocessing import Preprocessor, MODEL_HEIGHT, MODEL_WIDTH
+from metrics import collect_spans, current_trace, gauge, record_span, span
 
 class ConvLayer(nn.Module):
     def __init__(self, inputChannels, outputChannels):
@@ -45,31 +54,377 @@ class Model(nn.Module):
         return self.output(X)
 
 
-def get_inference(img: Image): #Needs to be a PIL.Image Object
+MODEL_PATH = os.getenv("MODEL_PATH", "ML/First Trial")
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "16"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "10"))
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "256"))
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "3600"))
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "eager")#eager | torchscript | int8 | onnx, see export_model.py
 
-    model=Model(in_channels=3, hidden_channels=10, hidden_layers=3, out_channels=2, height=480, width=640)
+#Exported artifacts sit next to the trained weights
+BACKEND_SUFFIXES = {'eager': '', 'torchscript': '.ts', 'int8': '.int8.ts', 'onnx': '.onnx'}
 
-    if torch.cuda.is_available():
-        model.load_state_dict(torch.load("ML/First Trial", map_location=torch.device('cuda')))
 
-    else:
-        model.load_state_dict(torch.load("ML/First Trial", map_location=torch.device('cpu')))
-    
-    tran = transforms.Compose([transforms.Resize((480, 640)), transforms.ToTensor()])
+def quantized_engine():
+    #qnnpack is the int8 kernel library for ARM (Raspberry Pi), fbgemm/x86 for desktop CPUs
+    if 'qnnpack' in torch.backends.quantized.supported_engines and platform.machine().lower().startswith(('arm', 'aarch')):
+        return 'qnnpack'
+    return 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'fbgemm'
 
-    img = tran(img)
-    img = torch.unsqueeze(img, dim=0)
-    preds = model(img)
 
-    preds = torch.nn.functional.softmax(preds, dim = 1)#logits to preds
-    labels = torch.argmax(preds, dim=1).item()
-
-    if labels == 0:
+def label_for(index: int):
+    if index == 0:
         return "Clean"
-    elif labels==1:
+    elif index == 1:
         return "Dirty"
     else:
         return "Empty"
 
 
-    
\ No newline at end of file
+def artifact_path(model_path, backend):
+    return model_path + BACKEND_SUFFIXES[backend]
+
+
+def build_model(out_channels=2):
+    return Model(in_channels=3, hidden_channels=10, hidden_layers=3, out_channels=out_channels, height=MODEL_HEIGHT, width=MODEL_WIDTH)
+
+
+def load_checkpoint(model_path=MODEL_PATH, device=torch.device('cpu')):
+    #Returns (state_dict, metadata). train.py checkpoints carry their metadata (version, classes, ...);
+    #older files such as ML/First Trial are a bare state_dict
+    checkpoint = torch.load(model_path, map_location=device)
+    if 'state_dict' in checkpoint and 'metadata' in checkpoint:
+        return checkpoint['state_dict'], checkpoint['metadata']
+    return checkpoint, {}
+
+
+def load_eager_model(model_path=MODEL_PATH, device=torch.device('cpu')):
+    state_dict, metadata = load_checkpoint(model_path, device)
+    model = build_model(out_channels=len(metadata['classes']) if 'classes' in metadata else 2)
+    model.load_state_dict(state_dict)
+    model.to(device)
+    model.eval()
+    return model
+
+
+class OnnxModel:
+    #Makes an onnxruntime session look like a torch module to the engine
+
+    def __init__(self, path):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, X: torch.Tensor):
+        return torch.from_numpy(self.session.run(None, {self.input_name: X.cpu().numpy()})[0])
+
+
+class InferenceEngine:
+    #Loads the weights once and is shared by every request/thread in the process
+
+    def __init__(self, model_path=MODEL_PATH, backend=INFERENCE_BACKEND, max_batch_size=MAX_BATCH_SIZE, warm_up=True):
+        if backend not in BACKEND_SUFFIXES:
+            raise ValueError(f"Unknown inference backend '{backend}', expected one of {', '.join(BACKEND_SUFFIXES)}")
+
+        self.backend = backend
+        self.model_path = artifact_path(model_path, backend)
+        #Quantized kernels and onnxruntime's CPU provider only run on the CPU
+        use_cuda = torch.cuda.is_available() and backend in ('eager', 'torchscript')
+        self.device = torch.device('cuda' if use_cuda else 'cpu')
+        self.max_batch_size = max_batch_size
+        self.preprocessor = Preprocessor(max_batch_size)
+        self.lock = threading.Lock()
+        self.load_time = 0.0
+        self.calls = 0
+        self.images = 0
+        self.total_latency = 0.0
+        self.last_latency = 0.0
+        self.warmed_up = False
+
+        start = time.perf_counter()
+        with open(self.model_path, 'rb') as f:
+            self.version = f"{backend}-{hashlib.sha256(f.read()).hexdigest()[:12]}"#results are only reusable for the same weights
+
+        if backend == 'eager':
+            self.model = load_eager_model(self.model_path, self.device)
+        elif backend == 'onnx':
+            self.model = OnnxModel(self.model_path)
+        else:
+            if backend == 'int8':
+                torch.backends.quantized.engine = quantized_engine()
+            self.model = torch.jit.load(self.model_path, map_location=self.device)
+            self.model.eval()
+
+        if warm_up:
+            self.warm_up()
+
+        self.load_time = time.perf_counter() - start
+        record_span('model_load', self.load_time)
+        print(f"Loaded {backend} model from {self.model_path} in {self.load_time*1000:.1f} ms")
+
+    def warm_up(self):
+        #Run once so the first request doesn't pay for LazyLinear setup and allocator growth
+        if not self.warmed_up:
+            with self.lock, torch.inference_mode():
+                self.model(torch.zeros(1, 3, MODEL_HEIGHT, MODEL_WIDTH, device=self.device))
+            self.warmed_up = True
+
+    def prepare(self, image, channels='RGB', shape=None):
+        #Decode/resize on the caller's thread; see Preprocessor.prepare for accepted inputs
+        with span('preprocess'):
+            return self.preprocessor.prepare(image, channels=channels, shape=shape)
+
+    def predict(self, img: Image):
+        return self.predict_batch([img])[0]
+
+    def predict_batch(self, images, max_batch_size=MAX_BATCH_SIZE):
+        max_batch_size = min(max_batch_size, self.max_batch_size)
+        results = []
+        for i in range(0, len(images), max_batch_size):
+            results.extend(self.forward([self.prepare(img) for img in images[i:i+max_batch_size]]))
+        return results
+
+    def forward(self, frames):
+        #frames are (array, channels) pairs from prepare()
+        start = time.perf_counter()
+        with self.lock, torch.inference_mode():
+            with span('preprocess'):
+                X = self.preprocessor.fill(frames).to(self.device, non_blocking=True)
+            with span('model'):
+                preds = self.model(X)
+            preds = torch.nn.functional.softmax(preds, dim=1)#logits to preds
+            confidence, labels = torch.max(preds, dim=1)
+            #Reading the results back waits for the GPU, and with it the non_blocking copy out of the shared
+            #pinned buffer, so the next fill() can't overwrite a batch that is still being copied
+            labels, confidence = labels.tolist(), confidence.tolist()
+        self.record(time.perf_counter() - start, len(frames))
+
+        return [(label_for(l), c) for l, c in zip(labels, confidence)]
+
+    def record(self, latency, batch_size=1):
+        self.calls += 1
+        self.images += batch_size
+        self.total_latency += latency
+        self.last_latency = latency
+
+    def stats(self):
+        return {
+            'backend': self.backend,
+            'model_path': self.model_path,
+            'version': self.version,
+            'device': str(self.device),
+            'load_time_ms': round(self.load_time*1000, 2),
+            'calls': self.calls,
+            'images': self.images,
+            'last_latency_ms': round(self.last_latency*1000, 2),
+            'mean_latency_ms': round((self.total_latency/self.calls)*1000, 2) if self.calls else 0.0,
+            'preprocessing': self.preprocessor.stats(),
+        }
+
+
+_engine = None
+_engine_lock = threading.RLock()
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = InferenceEngine()
+    return _engine
+
+
+class InferenceQueueFull(Exception):
+    pass
+
+
+class MicroBatcher:
+    #Collects single-image requests from many threads and runs them through the engine together.
+    #A batch is flushed when it is full or when the oldest request has waited max_wait_ms.
+
+    def __init__(self, engine: InferenceEngine, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS, max_queue=INFERENCE_QUEUE_SIZE):
+        self.engine = engine
+        self.max_batch_size = min(max_batch_size, engine.max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batches = 0
+        self.items = 0
+        self.rejected = 0
+        self.thread = threading.Thread(target=self.run, name="inference-batcher", daemon=True)
+        gauge('inference_queue_depth', 'Images waiting for the micro-batcher', self.queue.qsize)
+        self.thread.start()
+
+    def submit(self, image, timeout=None, channels='RGB', shape=None):
+        #Decoding happens on the caller's thread so only normalization and the forward pass are serialized
+        future = Future()
+        try:
+            #The caller's trace goes along so the batch's preprocess/model spans show up in its request
+            self.queue.put((self.engine.prepare(image, channels=channels, shape=shape), future, current_trace()),
+                           block=timeout is not None, timeout=timeout)
+        except queue.Full:
+            self.rejected += 1
+            raise InferenceQueueFull(f"Inference queue is full ({self.queue.maxsize} pending)")
+        return future
+
+    def classify(self, images, timeout=None):
+        futures = [self.submit(img, timeout=timeout) for img in images]
+        return [f.result() for f in futures]
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                with collect_spans() as spans:
+                    results = self.engine.forward([frame for frame, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future, trace), result in zip(batch, results):
+                    if trace is not None:
+                        trace.extend(spans)  # Before set_result, so it's there when the caller wakes up
+                    future.set_result(result)
+
+            self.batches += 1
+            self.items += len(batch)
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'max_queue': self.queue.maxsize,
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait*1000,
+            'batches': self.batches,
+            'items': self.items,
+            'rejected': self.rejected,
+            'mean_batch_size': round(self.items/self.batches, 2) if self.batches else 0.0,
+        }
+
+
+_batcher = None
+
+
+def get_batcher():
+    global _batcher
+    if _batcher is None:
+        with _engine_lock:
+            if _batcher is None:
+                _batcher = MicroBatcher(get_engine())
+    return _batcher
+
+
+def preload_engine():
+    #Loads the weights in a pre-fork master (gunicorn preload_app) so every worker shares them copy-on-write.
+    #No forward pass here: torch's OpenMP thread pool isn't fork-safe once it has been used
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = InferenceEngine(warm_up=False)
+    return _engine
+
+
+def init_worker_inference(threads=None):
+    #Call once per worker process after a fork. The batcher thread doesn't survive the fork,
+    #and the preloaded engine gets its first forward pass here instead of in the master
+    global _batcher
+    if threads:
+        torch.set_num_threads(threads)
+    with _engine_lock:
+        _batcher = None
+        get_engine().warm_up()
+    return get_batcher()
+
+
+def get_inference(img: Image): #Needs to be a PIL.Image Object
+    label, _ = get_batcher().submit(img).result()
+    return label
+
+
+def get_inference_batch(images, max_batch_size=MAX_BATCH_SIZE): #List of PIL.Image Objects
+    #Returns (label, confidence) for each image, classified in as few forward passes as possible
+    return get_engine().predict_batch(images, max_batch_size=max_batch_size)
+
+
+class ResultCache:
+    #LRU + TTL cache of (label, confidence) keyed by image content hash and model version
+
+    def __init__(self, max_entries=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(data: bytes, model_version: str):
+        return f"{model_version}:{hashlib.sha256(data).hexdigest()}"
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                if entry is not None:
+                    del self.entries[key]
+                    self.evictions += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, result):
+        with self.lock:
+            self.entries[key] = (result, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_entries': self.max_entries,
+            'ttl_s': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits/lookups, 4) if lookups else 0.0,
+        }
+
+
+result_cache = ResultCache()
+
+
+def classify_image_bytes(images):
+    #Classifies encoded images (list of bytes), only running the model for content it hasn't seen
+    version = get_engine().version
+    keys = [ResultCache.key(data, version) for data in images]
+    results = [result_cache.get(key) for key in keys]
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        for i, result in zip(missing, get_batcher().classify([images[i] for i in missing])):
+            result_cache.put(keys[i], result)
+            results[i] = result
+
+    return results
@@ -4,6 +4,8 @@ import time
 from datetime import datetime
 import numpy as np
 import base64
+import threading
+from collections import deque, namedtuple
 
 class VideoCamera(object):
     def __init__(self, flip=False, file_type=".jpg", photo_string="stream_photo"):
@@ -42,4 +44,96 @@ class VideoCamera(object):
         _, image_encoded = cv.imencode('.png', frame)
         image_base64 = base64.b64encode(image_encoded).decode('utf-8') 
 
-        return image_base64
\ No newline at end of file
+        return image_base64
+
+
+Frame = namedtuple("Frame", ["seq", "timestamp", "array", "jpeg"])
+
+class FrameProducer(object):
+    #Single background capture thread: every frame is grabbed and JPEG-encoded once,
+    #then shared by all stream clients, snapshots and inference pulls.
+    def __init__(self, camera, fps=15, buffer_size=4, quality=90, max_age=5.0, retry_delay=1.0):
+        self.camera = camera
+        self.interval = 1.0 / fps
+        self.quality = quality
+        self.max_age = max(max_age, 2 * self.interval)  # Older frames mean capture has stopped working
+        self.retry_delay = retry_delay
+        self.frames = deque(maxlen=buffer_size)
+        self.condition = threading.Condition()
+        self.running = threading.Event()
+        self.captured = 0
+        self.failures = 0
+        self.last_error = None
+        self.started_at = None
+        self.thread = None
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.running.set()
+            self.started_at = time.monotonic()
+            self.thread = threading.Thread(target=self.run, name="frame-producer", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        deadline = time.monotonic()
+        while self.running.is_set():
+            try:
+                array = self.camera.flip_if_needed(self.camera.picam2.capture_array())
+                ok, jpeg = cv.imencode('.jpg', array, [cv.IMWRITE_JPEG_QUALITY, self.quality])
+                if not ok:
+                    raise RuntimeError("JPEG encoding failed")
+            except Exception as e:
+                #Keep trying; meanwhile latest() reports the frames as stale instead of serving the last one forever
+                self.failures += 1
+                if str(e) != self.last_error:
+                    print(f"Frame capture failed: {e}")
+                self.last_error = str(e)
+                time.sleep(self.retry_delay)
+                deadline = time.monotonic()
+                continue
+
+            with self.condition:
+                self.captured += 1
+                self.frames.append(Frame(self.captured, time.time(), array, jpeg.tobytes()))
+                self.condition.notify_all()
+            self.last_error = None
+
+            #Fixed-rate deadlines; if capture fell behind, skip ahead rather than bursting
+            deadline += self.interval
+            now = time.monotonic()
+            if deadline < now:
+                deadline = now
+            time.sleep(deadline - now)
+
+    def latest(self, timeout=5.0):
+        #Waits up to timeout for a frame no older than max_age
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.frames and time.time() - self.frames[-1].timestamp <= self.max_age, timeout=timeout):
+                if not self.frames:
+                    raise TimeoutError("No frame captured yet")
+                raise TimeoutError(f"Latest frame is {time.time() - self.frames[-1].timestamp:.1f}s old: {self.last_error or 'camera stopped producing frames'}")
+            return self.frames[-1]
+
+    def next_frame(self, after_seq, timeout=5.0):
+        #Blocks until a frame newer than after_seq is available
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.frames and self.frames[-1].seq > after_seq, timeout=timeout):
+                raise TimeoutError("Camera stopped producing frames")
+            return self.frames[-1]
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0
+        return {
+            'target_fps': round(1.0 / self.interval, 2),
+            'actual_fps': round(self.captured / elapsed, 2) if elapsed else 0.0,
+            'frames': self.captured,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'last_frame_age_s': round(time.time() - self.frames[-1].timestamp, 3) if self.frames else None,
+        }
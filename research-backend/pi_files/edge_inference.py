@@ -0,0 +1,107 @@
+from datetime import datetime
+import threading
+import time
+import numpy as np
+import requests
+import torch
+
+LABELS = ["clean", "dirty", "empty"]
+
+
+class EdgeClassifier(object):
+    #Runs an exported TorchScript model (see export_model.py on the backend, the int8 one is the fastest here)
+    def __init__(self, model_path, threads=None):
+        if threads:
+            torch.set_num_threads(threads)
+        if 'qnnpack' in torch.backends.quantized.supported_engines:
+            torch.backends.quantized.engine = 'qnnpack'
+        self.model = torch.jit.load(model_path, map_location='cpu')
+        self.model.eval()
+
+    def classify(self, frame):
+        #frame is the BGR 480x640 array from Picamera2's RGB888 format
+        with torch.inference_mode():
+            X = torch.from_numpy(np.ascontiguousarray(frame[..., ::-1])).permute(2, 0, 1).unsqueeze(0).float().div_(255)
+            preds = torch.nn.functional.softmax(self.model(X), dim=1)
+            confidence, label = torch.max(preds, dim=1)
+        return LABELS[min(label.item(), len(LABELS) - 1)], confidence.item()
+
+
+class EdgeReporter(object):
+    #Classifies the latest frame every interval and reports only {status, confidence, captured_at} to the backend.
+    #The full frame is uploaded when the status changes or when request_upload() is called.
+    def __init__(self, producer, classifier, backend_url, system_id, interval=60.0):
+        self.producer = producer
+        self.classifier = classifier
+        self.backend_url = backend_url.rstrip('/')
+        self.system_id = system_id
+        self.interval = interval
+        self.session = requests.Session()
+        self.last_status = None
+        self.upload_requested = threading.Event()
+        self.running = threading.Event()
+        self.reports = 0
+        self.uploads = 0
+        self.thread = None
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.running.set()
+            self.thread = threading.Thread(target=self.run, name="edge-reporter", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.running.clear()
+
+    def request_upload(self):
+        self.upload_requested.set()
+
+    def run(self):
+        deadline = time.monotonic()
+        while self.running.is_set():
+            try:
+                self.report()
+                reported = True
+            except Exception as e:
+                print(f"Edge report failed: {e}")
+                reported = False
+
+            deadline += self.interval
+            now = time.monotonic()
+            if deadline < now:
+                deadline = now
+            if reported:
+                #Wakes early if someone asks for the frame
+                if self.upload_requested.wait(deadline - now):
+                    deadline = time.monotonic()
+            else:
+                #A pending upload request stays set after a failure; it is retried at the next deadline, not in a tight loop
+                time.sleep(deadline - now)
+
+    def report(self):
+        frame = self.producer.latest()
+        status, confidence = self.classifier.classify(frame.array)
+        data = {
+            'system_id': self.system_id,
+            'status': status,
+            'confidence': confidence,
+            'captured_at': datetime.utcfromtimestamp(frame.timestamp).isoformat(),
+        }
+
+        upload = status != self.last_status or self.upload_requested.is_set()
+        if upload:
+            response = self.session.post(f"{self.backend_url}/update_system_status", data=data,
+                                         files={'image': ('frame.jpg', frame.jpeg, 'image/jpeg')}, timeout=30)
+        else:
+            response = self.session.post(f"{self.backend_url}/update_system_status", json=data, timeout=10)
+        response.raise_for_status()
+
+        if upload:
+            self.upload_requested.clear()  # Only once the frame has actually been delivered
+            self.uploads += 1
+        self.last_status = status
+        self.reports += 1
+
+    def stats(self):
+        return {'last_status': self.last_status, 'reports': self.reports, 'uploads': self.uploads}
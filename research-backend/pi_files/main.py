@@ -1,29 +1,53 @@
 from flask import Flask, render_template, Response, request, send_from_directory, jsonify
-from camera import VideoCamera
+from camera import VideoCamera, FrameProducer
+import cv2 as cv
+import base64
 import os
+import time
+import numpy as np
+from datetime import datetime
 
 pi_camera = VideoCamera(flip=False)
+producer = FrameProducer(pi_camera, fps=float(os.getenv('CAMERA_FPS', '15'))).start()
+
+#Optional on-device mode: classify here and only send results (plus a frame on status change) to the backend
+reporter = None
+if os.getenv('ON_DEVICE_INFERENCE', 'false').lower() == 'true':
+    from edge_inference import EdgeClassifier, EdgeReporter
+    classifier = EdgeClassifier(os.getenv('MODEL_PATH', 'model.int8.ts'), threads=int(os.getenv('INFERENCE_THREADS', '0')) or None)
+    reporter = EdgeReporter(producer, classifier, os.environ['BACKEND_URL'], os.environ['SYSTEM_ID'],
+                            interval=float(os.getenv('INFERENCE_INTERVAL', '60'))).start()
 
 app = Flask(__name__)
 
+@app.errorhandler(TimeoutError)
+def camera_unavailable(e):
+    #producer.latest() raises this when there is no fresh frame, rather than handing out a stale one
+    return jsonify({"message": str(e)}), 503
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
-def gen(camera):
+def gen(producer):
+    seq = 0
     while True:
-        frame = camera.get_frame()
+        frame = producer.next_frame(seq)
+        seq = frame.seq
         yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n\r\n')
+               b'Content-Type: image/jpeg\r\n\r\n' + frame.jpeg + b'\r\n\r\n')
 
 @app.route('/video_feed')
 def video_feed():
-    return Response(gen(pi_camera),
+    return Response(gen(producer),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
 @app.route('/picture', methods=['POST'])
 def take_picture():#Change this to "Go Next"
-    pi_camera.take_picture()
+    frame = producer.latest()
+    today_date = datetime.now().strftime("%m%d%Y-%H%M%S")
+    with open(f"{pi_camera.photo_string}_{today_date}.jpg", 'wb') as f:
+        f.write(frame.jpeg)
     return "None"
 
 @app.route('/get_images', methods=['POST'])
@@ -32,7 +56,8 @@ def get_images():
         data=request.get_json()
         print("received data", data)
     
-        image = pi_camera.capture_image()
+        _, image_encoded = cv.imencode('.png', producer.latest().array)
+        image = base64.b64encode(image_encoded).decode('utf-8')
         
         
         files = {'image': image}
@@ -42,6 +67,40 @@ def get_images():
         print(e)
         return jsonify({"message": str(e)}), 200    
 
+@app.route('/get_frame', methods=['GET', 'POST'])
+def get_frame():
+    #Binary alternative to /get_images: ?format=jpeg (default) or ?format=raw
+    frame_format = request.args.get('format', 'jpeg')
+
+    latest = producer.latest()
+
+    if frame_format == 'raw':
+        array = np.ascontiguousarray(latest.array)
+        frame = array.tobytes()
+        headers = {'X-Frame-Format': 'raw', 'X-Frame-Shape': ','.join(map(str, array.shape)), 'X-Frame-Channels': 'BGR'}
+    else:
+        frame = latest.jpeg
+        headers = {'X-Frame-Format': 'jpeg'}
+    headers['X-Frame-Timestamp'] = str(latest.timestamp)
+    headers['X-Frame-Age-Ms'] = str(round((time.time() - latest.timestamp) * 1000))
+
+    return Response(frame, mimetype='application/octet-stream', headers=headers)
+
+@app.route('/camera_stats')
+def camera_stats():
+    stats = producer.stats()
+    if reporter:
+        stats['on_device'] = reporter.stats()
+    return jsonify(stats)
+
+@app.route('/upload_frame', methods=['POST'])
+def upload_frame():
+    #Lets the backend ask for the full frame when the Pi is only sending results
+    if not reporter:
+        return jsonify({"message": "On-device inference is not enabled"}), 400
+    reporter.request_upload()
+    return jsonify({"message": "Upload requested"}), 202
+
 if __name__ == '__main__':
 
 
@@ -6,7 +6,10 @@ USERNAME=$(echo $USER)
 sudo apt update && sudo apt upgrade -y
 sudo apt install -y python3 python3-pip dos2unix
 
-sudo at pip3 install numpy Picamera2 cv time datetime numpy base64 Flask
+sudo at pip3 install numpy Picamera2 cv time datetime numpy base64 Flask requests
+
+# Only needed for on-device inference (ON_DEVICE_INFERENCE=true): copy model.int8.ts from export_model.py next to main.py
+# pip3 install torch
 
 SERVER_SCRIPT="/home/$USERNAME/server/main.py"
 
@@ -0,0 +1,82 @@
+from PIL import Image
+from io import BytesIO
+import numpy as np
+import threading
+import time
+import torch
+import warnings
+
+MODEL_HEIGHT, MODEL_WIDTH = 480, 640
+
+# Picamera2's "RGB888" format is stored B, G, R in memory (the order OpenCV expects),
+# so frames coming straight from capture_array are BGR.
+PICAMERA_CHANNELS = 'BGR'
+
+
+class Preprocessor:
+    # Turns PIL images, numpy frames or encoded bytes into the model's input batch without PIL round trips.
+    # prepare() runs on the caller's thread and yields a uint8 HxWx3 array at model resolution;
+    # fill() writes a list of those into one preallocated (pinned when CUDA is present) float batch tensor.
+
+    def __init__(self, max_batch_size, height=MODEL_HEIGHT, width=MODEL_WIDTH, pin_memory=None):
+        self.height = height
+        self.width = width
+        pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        self.batch = torch.empty((max_batch_size, 3, height, width), dtype=torch.float32, pin_memory=pin_memory)
+        self.lock = threading.Lock()
+        self.timings = {stage: [0, 0.0] for stage in ('decode', 'resize', 'normalize')}
+
+    def timed(self, stage, start):
+        with self.lock:
+            self.timings[stage][0] += 1
+            self.timings[stage][1] += time.perf_counter() - start
+
+    def prepare(self, image, channels='RGB', shape=None):
+        # image: PIL.Image, numpy HxWx3 uint8 array, encoded bytes (JPEG/PNG/...) or raw bytes with shape.
+        # Returns (array, channels) where array is HxWx3 uint8 at model resolution
+        start = time.perf_counter()
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            if shape is not None:
+                array = np.frombuffer(image, dtype=np.uint8).reshape(shape)
+            else:
+                array = np.asarray(Image.open(BytesIO(image)).convert('RGB'))
+                channels = 'RGB'
+        elif isinstance(image, Image.Image):
+            array = np.asarray(image.convert('RGB'))
+            channels = 'RGB'
+        else:
+            array = image
+        array = array[..., :3]  # Drop an alpha/padding channel if there is one
+        self.timed('decode', start)
+
+        if array.shape[:2] != (self.height, self.width):
+            start = time.perf_counter()
+            # Only pay for a resize when the frame isn't already at model resolution
+            rgb = array if channels == 'RGB' else array[..., ::-1]
+            array = np.asarray(Image.fromarray(np.ascontiguousarray(rgb)).resize((self.width, self.height), Image.BILINEAR))
+            channels = 'RGB'
+            self.timed('resize', start)
+
+        return array, channels
+
+    def fill(self, frames):
+        # Writes prepared frames into the shared batch and returns a view of the filled rows.
+        # Callers must hold the engine lock: the batch buffer is reused by every forward pass
+        start = time.perf_counter()
+        batch = self.batch[:len(frames)]
+        for row, (array, channels) in zip(batch, frames):
+            with warnings.catch_warnings():
+                # Frames decoded from bytes are read-only; the tensor is only ever read from here
+                warnings.simplefilter('ignore', UserWarning)
+                source = torch.from_numpy(np.ascontiguousarray(array)).permute(2, 0, 1)
+            order = (2, 1, 0) if channels == 'BGR' else (0, 1, 2)
+            for target, channel in enumerate(order):
+                row[target].copy_(source[channel])
+        batch.mul_(1 / 255)  # Same scaling as transforms.ToTensor
+        self.timed('normalize', start)
+        return batch
+
+    def stats(self):
+        with self.lock:
+            return {stage: {'count': count, 'mean_ms': round(total / count * 1000, 3) if count else 0.0}
+                    for stage, (count, total) in self.timings.items()}
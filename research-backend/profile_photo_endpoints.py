@@ -1,53 +1,215 @@
-from flask import Flask, request, jsonify, send_from_directory
-from flask_cors import CORS
-from pymongo import MongoClient
+from flask import Blueprint, request, jsonify, send_from_directory
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps, UnidentifiedImageError
+import hashlib
 import os
-from werkzeug.utils import secure_filename
+import re
+import threading
+import time
 
-app = Flask(__name__)
-CORS(app)
-
-# Replace with your MongoDB URI if using Atlas
-client = MongoClient("mongodb://localhost:27017")
-db = client["mydb"]
-systems_col = db["systems"]
-users_col = db["users"]
+# Profile photos: uploads are streamed to disk under a size cap and stored under their content hash,
+# square thumbnails are made off the request thread, and serving goes through an in-memory
+# username -> filename cache with strong ETags so avatars cost neither a DB round trip nor megabytes.
 
 PROFILE_PHOTO_DIR = os.path.join(os.path.dirname(__file__), 'profile_photos')
-os.makedirs(PROFILE_PHOTO_DIR, exist_ok=True)
+MAX_PROFILE_PHOTO_BYTES = int(os.getenv('MAX_PROFILE_PHOTO_BYTES', str(5 * 1024 * 1024)))
+PROFILE_PHOTO_MAX_AGE = int(os.getenv('PROFILE_PHOTO_MAX_AGE', '300'))
+THUMBNAIL_SIZES = (64, 128, 256)  # The profile page shows 120px, so 256 covers 2x displays
+THUMBNAIL_FORMATS = {'webp': ('WEBP', 80), 'jpg': ('JPEG', 85)}
+HASHED_NAME = re.compile(r'^[0-9a-f]{64}\.\w+$')
+CHUNK_SIZE = 64 * 1024
+
+
+class PhotoTooLarge(Exception):
+    pass
+
+
+class ProfilePhotoStore:
+    def __init__(self, photo_dir, max_bytes=MAX_PROFILE_PHOTO_BYTES, sizes=THUMBNAIL_SIZES, cache_ttl=60.0, cache_size=10000):
+        self.photo_dir = photo_dir
+        self.max_bytes = max_bytes
+        self.sizes = sizes
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.users_col = None
+        self.cache = {}
+        self.lock = threading.Lock()
+        # Threads are only started on the first submit, so this is safe to create before forking
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="thumbnailer")
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(photo_dir, exist_ok=True)
+
+    def bind(self, users_col):
+        self.users_col = users_col
+        return self
+
+    def lookup(self, username):
+        # Users without a photo are cached too, since that is the common case. Other worker processes
+        # pick up a change once their entry expires; the ETag check keeps clients correct meanwhile
+        now = time.monotonic()
+        with self.lock:
+            entry = self.cache.get(username)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        user = self.users_col.find_one({'username': username}, {'profile_photo': 1})
+        filename = user.get('profile_photo') if user else None
+        self.remember(username, filename)
+        return filename
+
+    def remember(self, username, filename):
+        with self.lock:
+            self.cache.pop(username, None)
+            if len(self.cache) >= self.cache_size:
+                self.cache.pop(next(iter(self.cache)))  # Oldest entry
+            self.cache[username] = (filename, time.monotonic() + self.cache_ttl)
+
+    def save(self, stream):
+        # Copies the upload to disk in chunks, hashing as it goes, and returns the content-hashed filename.
+        # Raises PhotoTooLarge past max_bytes and ValueError if the data isn't an image
+        digest = hashlib.sha256()
+        size = 0
+        tmp_path = os.path.join(self.photo_dir, f"upload.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp_path, 'wb') as f:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise PhotoTooLarge(f"Photo is larger than {self.max_bytes // (1024 * 1024)} MB")
+                    digest.update(chunk)
+                    f.write(chunk)
+
+            try:
+                with Image.open(tmp_path) as image:
+                    extension = image.format.lower()
+                    image.verify()
+            except (UnidentifiedImageError, OSError, SyntaxError) as e:
+                raise ValueError(f"Not an image: {e}")
+
+            filename = f"{digest.hexdigest()}.{'jpg' if extension == 'jpeg' else extension}"
+            os.replace(tmp_path, os.path.join(self.photo_dir, filename))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self.executor.submit(self.make_thumbnails, filename)
+        return filename
+
+    def thumbnail_name(self, filename, size, extension):
+        return f"{filename.split('.')[0]}_{size}.{extension}"
+
+    def make_thumbnails(self, filename):
+        try:
+            with Image.open(os.path.join(self.photo_dir, filename)) as image:
+                image = ImageOps.exif_transpose(image).convert('RGB')
+                for size in sorted(self.sizes, reverse=True):
+                    # Each size is cropped square and scaled down from the previous, larger one
+                    image = ImageOps.fit(image, (size, size), Image.LANCZOS)
+                    for extension, (fmt, quality) in THUMBNAIL_FORMATS.items():
+                        path = os.path.join(self.photo_dir, self.thumbnail_name(filename, size, extension))
+                        image.save(f"{path}.tmp", format=fmt, quality=quality)
+                        os.replace(f"{path}.tmp", path)
+        except Exception as e:
+            print(f"Thumbnailing {filename} failed: {e}")
+
+    def variant(self, filename, size, extension):
+        # Returns (filename, etag) of the best file to send: the smallest thumbnail at least `size` wide,
+        # or the original for photos stored before thumbnailing / while thumbnails are still being made
+        if HASHED_NAME.match(filename):
+            size = next((s for s in sorted(self.sizes) if s >= size), max(self.sizes))
+            thumbnail = self.thumbnail_name(filename, size, extension)
+            if os.path.exists(os.path.join(self.photo_dir, thumbnail)):
+                return thumbnail, thumbnail
+            return filename, filename
+        return filename, None  # Legacy name: let send_file derive the ETag from mtime and size
 
-@app.route('/upload_profile_photo', methods=['POST'])
+    def remove(self, filename):
+        # Content-hashed files can be shared by several users, so only delete once nobody references them
+        if self.users_col.count_documents({'profile_photo': filename}, limit=1):
+            return
+        names = [filename]
+        if HASHED_NAME.match(filename):
+            names += [self.thumbnail_name(filename, size, extension) for size in self.sizes for extension in THUMBNAIL_FORMATS]
+        for name in names:
+            path = os.path.join(self.photo_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+photo_store = ProfilePhotoStore(PROFILE_PHOTO_DIR)
+profile_photos = Blueprint('profile_photos', __name__)
+
+
+@profile_photos.route('/upload_profile_photo', methods=['POST'])
 def upload_profile_photo():
+    # Werkzeug stops reading the body with a 413 as soon as it passes this cap
+    request.max_content_length = MAX_PROFILE_PHOTO_BYTES + 64 * 1024  # Room for the multipart envelope
     username = request.form.get('username')
+
     if 'photo' not in request.files or not username:
         return jsonify({'success': False, 'message': 'Photo and username required'}), 400
+
     file = request.files['photo']
     if file.filename == '':
         return jsonify({'success': False, 'message': 'No selected file'}), 400
-    filename = secure_filename(f"{username}_profile_{file.filename}")
-    filepath = os.path.join(PROFILE_PHOTO_DIR, filename)
-    file.save(filepath)
-    users_col.update_one({'username': username}, {'$set': {'profile_photo': filename}})
-    return jsonify({'success': True, 'filename': filename})
 
-@app.route('/remove_profile_photo', methods=['POST'])
+    try:
+        filename = photo_store.save(file.stream)
+    except PhotoTooLarge as e:
+        return jsonify({'success': False, 'message': str(e)}), 413
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Photo must be an image'}), 400
+
+    user = photo_store.users_col.find_one_and_update({'username': username}, {'$set': {'profile_photo': filename}},
+                                                     {'profile_photo': 1})
+    if user and user.get('profile_photo') not in (None, filename):
+        photo_store.remove(user['profile_photo'])
+    photo_store.remember(username, filename)
+
+    return jsonify({'success': True, 'filename': filename, 'version': filename.split('.')[0]})
+
+
+@profile_photos.route('/remove_profile_photo', methods=['POST'])
 def remove_profile_photo():
     data = request.get_json()
     username = data.get('username')
-    user = users_col.find_one({'username': username})
+
+    user = photo_store.users_col.find_one({'username': username}, {'profile_photo': 1})
     if not user or 'profile_photo' not in user:
         return jsonify({'success': False, 'message': 'No profile photo to remove'}), 400
-    filename = user['profile_photo']
-    filepath = os.path.join(PROFILE_PHOTO_DIR, filename)
-    if os.path.exists(filepath):
-        os.remove(filepath)
-    users_col.update_one({'username': username}, {'$unset': {'profile_photo': ''}})
+
+    photo_store.users_col.update_one({'username': username}, {'$unset': {'profile_photo': ''}})
+    photo_store.remove(user['profile_photo'])
+    photo_store.remember(username, None)
     return jsonify({'success': True})
 
-@app.route('/profile_photo/<username>')
+
+@profile_photos.route('/profile_photo/<username>')
 def serve_profile_photo(username):
-    user = users_col.find_one({'username': username})
-    if not user or 'profile_photo' not in user:
+    # ?size=N picks a thumbnail (default 256). ?v=<version> from the upload response marks a
+    # content-addressed URL that browsers may cache for good
+    filename = photo_store.lookup(username)
+    if not filename:
         return jsonify({'success': False, 'message': 'No profile photo'}), 404
-    filename = user['profile_photo']
-    return send_from_directory(PROFILE_PHOTO_DIR, filename)
+
+    extension = 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'jpg'
+    path, etag = photo_store.variant(filename, request.args.get('size', max(THUMBNAIL_SIZES), type=int), extension)
+    if path == filename and etag is not None:
+        max_age = 0  # Thumbnails are still being made; revalidate so the client switches to them
+    elif request.args.get('v') == filename.split('.')[0]:
+        max_age = 31536000
+    else:
+        max_age = PROFILE_PHOTO_MAX_AGE
+
+    response = send_from_directory(PROFILE_PHOTO_DIR, path, etag=etag if etag is not None else True,
+                                   max_age=max_age, conditional=True)
+    response.vary.add('Accept')
+    if max_age == 31536000:
+        response.cache_control.immutable = True
+    return response
@@ -1,16 +1,53 @@
-from flask import Flask, request
+from flask import Flask, request, jsonify
 from flask_cors import CORS
 import requests
 import base64
 from io import BytesIO
 from PIL import Image
-import time
-import threading
+import numpy as np
 from bson.objectid import ObjectId
-from ml_scripts import get_inference
+from pymongo import MongoClient
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from ml_scripts import get_batcher
+from capture_scheduler import CaptureScheduler
+from system_status import store_latest_status
+from status_events import STATUS_EVENTS_COLLECTION, publish_change
+from readings import ReadingStore
+from alerts import AlertDispatcher
+from change_detection import ChangeGate, CHANGE_THRESHOLD, FORCE_INFERENCE_EVERY
+from metrics import MongoListener, init_app
+import os
+
+load_dotenv()
 
 app = Flask(__name__)
 CORS(app)
+init_app(app)
+
+client = MongoClient("mongodb://localhost:27017", event_listeners=[MongoListener()])
+db = client["mydb"]
+systems_col = db["systems"]
+status_events_col = db[STATUS_EVENTS_COLLECTION]
+
+scheduler = CaptureScheduler()
+reading_store = ReadingStore(db["readings"], os.path.join(os.path.dirname(__file__), 'readings'), rollups_col=db["reading_rollups"]).start()
+
+# Dirty results from capture jobs queue alerts in the same outbox as app.py, with the same settings;
+# digests are leased per user, so this dispatcher and the app's never send the same alerts twice
+alert_dispatcher = AlertDispatcher(
+    outbox_col=db["alert_outbox"],
+    users_col=db["users"],
+    smtp_host=os.getenv('MAIL_SERVER', 'smtp.gmail.com'),
+    smtp_port=int(os.getenv('MAIL_PORT', '587')),
+    sender=os.getenv('EMAIL_USER'),
+    smtp_user=os.getenv('EMAIL_USER'),
+    smtp_password=os.getenv('EMAIL_PASS'),
+    use_tls=os.getenv('MAIL_USE_TLS', 'true').lower() == 'true',
+    cooldown=timedelta(minutes=int(os.getenv('ALERT_COOLDOWN_MINUTES', '60'))),
+    digest_window=timedelta(seconds=int(os.getenv('ALERT_DIGEST_SECONDS', '30')))
+)
+alert_dispatcher.start()
 
 def decode_image(encoded_img):
     
@@ -20,79 +57,93 @@ def decode_image(encoded_img):
 
     return img
 
-@app.route('/send_dur_and_freq', methods=['POST'])
-def sending_data(stoping, duration, frequency):
+def decode_frame(response):
+    #Decodes a binary frame from the Pi's /get_frame endpoint
+    if response.headers.get('X-Frame-Format') == 'raw':
+        shape = tuple(int(n) for n in response.headers['X-Frame-Shape'].split(','))
+        frame = np.frombuffer(response.content, dtype=np.uint8).reshape(shape)#no copy of the payload
+        if response.headers.get('X-Frame-Channels', 'BGR') == 'BGR':
+            frame = frame[..., ::-1]
+        return Image.fromarray(np.ascontiguousarray(frame))
 
-    url = 'http://10.4.119.62:5000/get_images'#Need to amke dynamic with difference cameras ips, miht need to write script to make the ip static in server.sh
-    data = {'duration': duration, 'frequency': frequency}
-    headers = {'Content-Type': 'application/json'}
-    
-    if duration != None:
-        try:
-            number_of_images = (duration*frequency)
-            for i in range(number_of_images+1):
-
-                if stoping.is_set():
-                    return "Stopped Early"
-                
-                #Turn On LED
-
-                response = requests.post(url, json=data, headers=headers)
-                image = decode_image(encoded_img=response.json()['image'])
-                image.save(f"images/image_{i}.png")
-                
-                #turn off LED
-
-                if i != number_of_images:
-                    time.sleep(((1/frequency)*60)-.1)#needs to sleep for that amount of time in the code for LED to turn on
-            
-            print("done")
-            return "Received Message"
-
-        except requests.exceptions.RequestException as e:
-            print(e)
-            return f"Error sending data: {e}", 500
-
-    else:
-        while True:
-            print(duration, frequency)
-            if stoping.is_set():
-                    return "Stopped Early"
-                
-                #Turn On LED
-
-            response = requests.post(url, json=data, headers=headers)
-            image = decode_image(encoded_img=response.json()['image'])
-            result = get_inference(image)
-
-            if result != "Clean":
-                return result
-                
-                #turn off LED
-
-            if i != number_of_images:
-                time.sleep(((1/frequency)*360)-.1)
-
-
-@app.route("/stop")
+    return Image.open(BytesIO(response.content))
+
+def frame_input(response):
+    #(image, channels, shape) for the inference engine, straight from a /get_frame response with no PIL decode
+    if response.headers.get('X-Frame-Format') == 'raw':
+        shape = tuple(int(n) for n in response.headers['X-Frame-Shape'].split(','))
+        return response.content, response.headers.get('X-Frame-Channels', 'BGR'), shape
+    return response.content, 'RGB', None
+
+DEFAULT_CAMERA_URL = 'http://10.4.119.62:5000'#Cameras registered with a camera_url are polled by fleet_poller.py instead
+
+def capture_tick(camera_url, system_id, stop_on_dirty):
+    #One capture: pull a frame from the Pi, classify it (unless it looks unchanged) and store the result
+    gate = ChangeGate(threshold=CHANGE_THRESHOLD, force_every=FORCE_INFERENCE_EVERY)
+
+    def tick(job, i):
+        #Turn On LED
+
+        response = requests.get(f"{camera_url}/get_frame", params={'format': 'jpeg'})
+        response.raise_for_status()
+        captured_at = datetime.utcnow()
+        image, channels, shape = frame_input(response)
+
+        #turn off LED
+
+        result, confidence = gate.classify(image, lambda img: get_batcher().submit(img, channels=channels, shape=shape).result(), shape=shape)
+        if system_id:
+            before = store_latest_status(systems_col, system_id, result, confidence, captured_at)
+            reading_store.add(system_id, result, confidence, captured_at, image=image, channels=channels, shape=shape)
+            if before:
+                alert_dispatcher.notify_status(before, result.lower())
+            publish_change(status_events_col, before, result, confidence, captured_at)
+
+        return not (stop_on_dirty and result != "Clean")
+
+    tick.stats = lambda: {'change_gate': gate.stats()}
+    return tick
+
+
+@app.route("/stop", methods=["GET", "POST"])
 def stop():
-    global stop_pictures
-    stop_pictures.set()
-    return "Stopped"
+    job_id = request.args.get("job_id") or (request.get_json(silent=True) or {}).get("job_id")
+    stopped = scheduler.stop(job_id)
+    if job_id and not stopped:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    return jsonify({'success': True, 'stopped': stopped})
 
 
 
 @app.route("/start", methods=["POST"])
 def start():
         
-    data = request.get_json()
-    duration = data.get("duration")
-    frequency = data.get("frequency")
-
-    global thread, stop_pictures
-    if thread is None or not thread.is_alive():
-        stop_pictures.clear()
-        thread = threading.Thread(target=sending_data, args=(stop_pictures, duration, frequency))
-        thread.start()
+    data = request.get_json(silent=True) or {}
+    duration = data.get("duration")#minutes, or None to run until the water isn't clean
+    frequency = data.get("frequency")#captures per minute
+    system_id = data.get("system_id")
+    camera_url = data.get("camera_url", DEFAULT_CAMERA_URL).rstrip('/')
+
+    if isinstance(frequency, bool) or not isinstance(frequency, (int, float)) or frequency <= 0:
+        return jsonify({'success': False, 'message': 'Frequency must be a positive number'}), 400
+    if duration is not None and (isinstance(duration, bool) or not isinstance(duration, (int, float)) or duration <= 0):
+        return jsonify({'success': False, 'message': 'Duration must be a positive number of minutes'}), 400
+
+    if system_id is not None and not (isinstance(system_id, str) and ObjectId.is_valid(system_id)):
+        return jsonify({'success': False, 'message': 'Invalid system ID'}), 400
+    if system_id is not None and not systems_col.count_documents({'_id': ObjectId(system_id)}, limit=1):
+        return jsonify({'success': False, 'message': 'System not found'}), 404
+
+    count = int(duration*frequency) + 1 if duration is not None else None
+    job_id = scheduler.start(capture_tick(camera_url, system_id, stop_on_dirty=duration is None), interval=60/frequency, count=count)
         
-    return "started"
\ No newline at end of file
+    return jsonify({'success': True, 'job_id': job_id})
+
+
+@app.route("/status")
+@app.route("/status/<job_id>")
+def status(job_id=None):
+    job_status = scheduler.status(job_id)
+    if job_id and job_status is None:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    return jsonify(job_status)
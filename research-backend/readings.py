@@ -0,0 +1,225 @@
+from datetime import datetime, timedelta
+from io import BytesIO
+from PIL import Image
+from bson.objectid import ObjectId
+from collections import defaultdict
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+import numpy as np
+import hashlib
+import os
+import threading
+
+READING_PROJECTION = {'_id': 0, 'timestamp': 1, 'status': 1, 'confidence': 1, 'image': 1}
+ROLLUP_STATUSES = ('clean', 'dirty', 'empty')
+ROLLUP_GRANULARITIES = {
+    'hour': lambda ts: ts.replace(minute=0, second=0, microsecond=0),
+    'day': lambda ts: ts.replace(hour=0, minute=0, second=0, microsecond=0),
+}
+
+
+class ReadingStore:
+    # Every capture becomes one document in the readings time-series collection:
+    # {system_id, timestamp, status, confidence, image}. Images are stored once on disk under
+    # their content hash, so repeated identical frames cost no extra space.
+    # Inserts are buffered and written with insert_many in batches. When a rollups collection is given,
+    # per-hour and per-day counts are maintained incrementally with each flush so history reads never scan readings.
+
+    def __init__(self, readings_col, image_dir, rollups_col=None, image_format='webp', quality=80, batch_size=100, flush_interval=2.0,
+                 max_pending=10000):
+        self.readings_col = readings_col
+        self.rollups_col = rollups_col
+        self.image_dir = image_dir
+        self.image_format = image_format
+        self.quality = quality
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending  # Readings kept for retry while Mongo is unreachable
+        self.pending = []
+        self.pending_rollups = []  # Rollup updates for readings already written, kept for retry if their write fails
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.flush_requested = threading.Event()
+        self.thread = None
+        os.makedirs(self.image_dir, exist_ok=True)
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run, name="reading-flusher", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        self.flush_requested.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+    def run(self):
+        while True:
+            self.flush_requested.wait(self.flush_interval)
+            self.flush_requested.clear()
+            if self.stopping.is_set():
+                break
+            self.try_flush()
+
+    def try_flush(self):
+        # Failed batches are requeued by flush(), so the next attempt retries them
+        try:
+            return self.flush()
+        except Exception as e:
+            print(f"Failed to write readings: {e}")
+            return 0
+
+    def store_image(self, image, channels='RGB', shape=None):
+        # Accepts a PIL image or raw pixel bytes with their shape (both compressed to image_format),
+        # or already-encoded bytes, which are stored as-is under the extension of their actual format.
+        # Returns the path relative to image_dir; raises ValueError for bytes that aren't an image
+        if shape is not None and not isinstance(image, Image.Image):
+            array = np.frombuffer(image, dtype=np.uint8).reshape(shape)[..., :3]
+            image = Image.fromarray(np.ascontiguousarray(array[..., ::-1] if channels == 'BGR' else array))
+
+        if isinstance(image, Image.Image):
+            buffer = BytesIO()
+            image.convert('RGB').save(buffer, format=self.image_format, quality=self.quality)
+            data, extension = buffer.getvalue(), self.image_format
+        else:
+            data, extension = image, image_extension(image)
+
+        digest = hashlib.sha256(data).hexdigest()
+        relative_path = os.path.join(digest[:2], f"{digest}.{extension}")
+        path = os.path.join(self.image_dir, relative_path)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"  # Unique across threads and forked workers
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return relative_path
+
+    def add(self, system_id, status, confidence, timestamp=None, image=None, channels='RGB', shape=None):
+        reading = {
+            'system_id': ObjectId(system_id),
+            'timestamp': timestamp or datetime.utcnow(),
+            'status': status.lower(),
+            'confidence': float(confidence),
+        }
+        if image is not None:
+            try:
+                reading['image'] = self.store_image(image, channels=channels, shape=shape)
+            except ValueError as e:
+                print(f"Not storing image for system {system_id}: {e}")
+
+        with self.lock:
+            self.pending.append(reading)
+            full = len(self.pending) >= self.batch_size
+        if full:
+            # Written by the flusher thread so a Mongo outage never fails (or stalls) the caller's request
+            if self.thread is not None and self.thread.is_alive():
+                self.flush_requested.set()
+            else:
+                self.try_flush()
+        return reading
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+            rollups, self.pending_rollups = self.pending_rollups, []
+        if batch:
+            try:
+                self.readings_col.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                # The other documents were written; the rejected ones would be rejected again
+                failed = {error['index'] for error in e.details.get('writeErrors', [])}
+                print(f"Dropped {len(failed)} invalid readings: {e}")
+                batch = [reading for i, reading in enumerate(batch) if i not in failed]
+            except Exception:
+                self.requeue(batch, rollups)
+                raise
+            if self.rollups_col is not None:
+                rollups += rollup_updates(batch)
+
+        # Rollups are retried on their own: the readings they count are already stored and mustn't be written twice
+        if rollups:
+            try:
+                self.rollups_col.bulk_write(rollups, ordered=False)
+            except BulkWriteError as e:
+                failed = {error['index'] for error in e.details.get('writeErrors', [])}
+                self.requeue([], [update for i, update in enumerate(rollups) if i in failed])
+                raise
+            except Exception:
+                self.requeue([], rollups)
+                raise
+        return len(batch)
+
+    def requeue(self, batch, rollups=()):
+        # Put writes that failed back in front of newer ones, so the next flush retries them.
+        # If Mongo stays down past max_pending readings the oldest are dropped
+        with self.lock:
+            self.pending[:0] = batch
+            self.pending_rollups[:0] = rollups
+            overflow = len(self.pending) - self.max_pending
+            if overflow > 0:
+                del self.pending[:overflow]
+                print(f"Readings backlog full, dropped the {overflow} oldest")
+            overflow = len(self.pending_rollups) - self.max_pending
+            if overflow > 0:
+                del self.pending_rollups[:overflow]
+                print(f"Rollup backlog full, dropped the {overflow} oldest updates")
+
+    def history(self, system_id, start=None, end=None, limit=None):
+        end = end or datetime.utcnow()
+        start = start or end - timedelta(hours=24)
+        cursor = self.readings_col.find(
+            {'system_id': ObjectId(system_id), 'timestamp': {'$gte': start, '$lt': end}},
+            READING_PROJECTION
+        ).sort('timestamp', 1)
+        if limit:
+            cursor = cursor.limit(limit)
+        return list(cursor)
+
+    def rollups(self, system_id, granularity, start, end):
+        buckets = self.rollups_col.find(
+            {'system_id': ObjectId(system_id), 'granularity': granularity, 'bucket': {'$gte': start, '$lt': end}},
+            {'_id': 0, 'bucket': 1, 'count': 1, 'confidence_sum': 1, **{status: 1 for status in ROLLUP_STATUSES}}
+        ).sort('bucket', 1)
+
+        return [{
+            'bucket': bucket['bucket'],
+            'count': bucket['count'],
+            **{status: bucket.get(status, 0) for status in ROLLUP_STATUSES},
+            'mean_confidence': round(bucket['confidence_sum'] / bucket['count'], 4) if bucket['count'] else None,
+        } for bucket in buckets]
+
+
+def image_extension(data):
+    # File extension for encoded image bytes, from their content rather than trusting the sender
+    try:
+        with Image.open(BytesIO(data)) as image:  # Only reads the header
+            image_format = image.format
+    except Exception as e:
+        raise ValueError(f"Unrecognized image data ({e})")
+    return 'jpg' if image_format == 'JPEG' else image_format.lower()
+
+
+def rollup_updates(readings):
+    # Collapses a batch of readings into one $inc upsert per (system, granularity, bucket)
+    totals = defaultdict(lambda: defaultdict(float))
+    for reading in readings:
+        for granularity, truncate in ROLLUP_GRANULARITIES.items():
+            key = (reading['system_id'], granularity, truncate(reading['timestamp']))
+            totals[key]['count'] += 1
+            totals[key]['confidence_sum'] += reading['confidence']
+            if reading['status'] in ROLLUP_STATUSES:
+                totals[key][reading['status']] += 1
+
+    return [
+        UpdateOne(
+            {'system_id': system_id, 'granularity': granularity, 'bucket': bucket},
+            {'$inc': {field: (value if field == 'confidence_sum' else int(value)) for field, value in fields.items()}},
+            upsert=True
+        )
+        for (system_id, granularity, bucket), fields in totals.items()
+    ]
@@ -0,0 +1,63 @@
+from datetime import datetime
+import json
+from pymongo import CursorType
+
+# Status changes are written to the capped 'status_events' collection by every write path (the Flask app,
+# the Pi capture jobs, the fleet poller) and tailed by status_stream.py, which pushes them to dashboards.
+# A capped collection works on a standalone server and across processes, unlike an in-process broker.
+
+STATUS_EVENTS_COLLECTION = 'status_events'
+STATUS_EVENTS_BYTES = 16 * 1024 * 1024
+
+
+def status_event(system, status, confidence=None, captured_at=None):
+    # Small payload pushed to dashboards; confidence is shown x100 like /get_systems_data.
+    # Fields that weren't reported are left out so clients keep what they already have
+    event = {'id': str(system['_id']), 'name': system.get('name'), 'status': status.lower()}
+    if confidence is not None:
+        event['confidence'] = round(confidence * 100, 2)
+    if captured_at is not None:
+        event['lastUpdated'] = captured_at.isoformat() if isinstance(captured_at, datetime) else captured_at
+    return event
+
+
+def format_sse(event, data, event_id=None):
+    lines = [f"event: {event}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(data)}")
+    return '\n'.join(lines) + '\n\n'
+
+
+def publish_change(events_col, system_before, status, confidence=None, captured_at=None):
+    # system_before is the document before the update; nothing is written unless the status actually changed
+    if system_before is None or system_before.get('status') == status.lower():
+        return False
+    events_col.insert_one({
+        'username': system_before.get('username'),
+        'event': status_event(system_before, status, confidence, captured_at),
+        'created_at': datetime.utcnow(),
+    })
+    return True
+
+
+def tail_events(events_col, on_event, stopping, poll_interval=0.5):
+    # Calls on_event(username, event) for every event inserted after this starts, until stopping is set.
+    # On a capped collection the tailable cursor waits server-side for new documents; when it dies
+    # (empty collection, or a plain collection under mongomock) it is reopened after poll_interval
+    newest = events_col.find_one({}, {'_id': 1}, sort=[('$natural', -1)])
+    last_id = newest['_id'] if newest else None
+
+    while not stopping.is_set():
+        try:
+            # The server holds each getMore open for up to a second waiting for new documents
+            cursor = events_col.find({'_id': {'$gt': last_id}} if last_id else {}, cursor_type=CursorType.TAILABLE_AWAIT)
+            while not stopping.is_set():
+                for document in cursor:
+                    last_id = document['_id']
+                    on_event(document['username'], document['event'])
+                if not cursor.alive:
+                    break
+        except Exception as e:
+            print(f"Tailing status events failed: {e}")
+        stopping.wait(poll_interval)
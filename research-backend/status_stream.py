@@ -0,0 +1,148 @@
+#Server-sent events for dashboards, run as its own asyncio process next to the Flask app so open streams
+#never hold a request thread there: python status_stream.py   (STREAM_PORT, default 5001)
+#GET /systems/stream?username=  sends a snapshot on connect, then an event only when a system's status changes.
+#Events come from the capped status_events collection, so changes written by any gunicorn worker, Pi capture
+#job or fleet_poller.py reach every dashboard.
+from collections import deque
+import asyncio
+import os
+import threading
+from aiohttp import web
+from pymongo import MongoClient
+from db_indexes import ensure_collections
+from status_events import STATUS_EVENTS_COLLECTION, format_sse, tail_events
+from system_status import DASHBOARD_PROJECTION, to_dashboard_entry
+
+KEEPALIVE_SECONDS = 15
+
+
+class Subscription:
+    def __init__(self, username, max_pending):
+        self.username = username
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.ready = asyncio.Event()
+        self.overflowed = False
+
+    async def next_events(self, timeout):
+        # Returns the events queued since the last call, or [] after timeout
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self.ready.clear()
+        events, self.pending = list(self.pending), deque()
+        return events
+
+
+class StatusBroker:
+    # Fan-out to the streams open in this process, keyed by username. Everything runs on the event loop,
+    # so a subscriber costs a deque and an Event rather than a thread
+
+    def __init__(self, max_pending=100):
+        self.max_pending = max_pending
+        self.subscribers = {}
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def subscribe(self, username):
+        subscription = Subscription(username, self.max_pending)
+        self.subscribers.setdefault(username, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscribers = self.subscribers.get(subscription.username)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self.subscribers[subscription.username]
+
+    def publish(self, username, event):
+        self.published += 1
+        for subscription in list(self.subscribers.get(username, ())):
+            if len(subscription.pending) >= subscription.max_pending:
+                # A client that can't keep up is disconnected; it gets a fresh snapshot when it reconnects
+                subscription.overflowed = True
+                self.dropped += 1
+                self.unsubscribe(subscription)
+            else:
+                subscription.pending.append(event)
+                self.delivered += 1
+            subscription.ready.set()
+
+    def stats(self):
+        return {
+            'subscribers': sum(len(subscribers) for subscribers in self.subscribers.values()),
+            'published': self.published,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+        }
+
+
+def cors(response):
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+async def systems_stream(request):
+    username = request.query.get('username')
+    if not username:
+        return cors(web.json_response({'success': False, 'message': 'Username required'}, status=400))
+
+    broker = request.app['broker']
+    # Subscribe before reading the snapshot so a change in between isn't lost
+    subscription = broker.subscribe(username)
+    try:
+        response = cors(web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache',
+                                                    'X-Accel-Buffering': 'no'}))
+        await response.prepare(request)
+        snapshot = await asyncio.to_thread(request.app['load_snapshot'], username)
+        await response.write(('retry: 5000\n\n' + format_sse('snapshot', snapshot)).encode())
+
+        while not subscription.overflowed:
+            events = await subscription.next_events(KEEPALIVE_SECONDS)
+            # Comments keep proxies from closing the connection and let us notice clients that went away
+            await response.write(''.join(format_sse('status', event) for event in events).encode() if events else b': keepalive\n\n')
+        return response
+    except ConnectionResetError:
+        return response  # The dashboard went away
+    finally:
+        broker.unsubscribe(subscription)
+
+
+async def stream_stats(request):
+    return cors(web.json_response(request.app['broker'].stats()))
+
+
+def create_app(systems_col, events_col=None, broker=None, poll_interval=0.5):
+    # With events_col, a background thread tails it into the broker; without one the caller feeds broker.publish
+    app = web.Application()
+    app['broker'] = broker or StatusBroker()
+    app['load_snapshot'] = lambda username: [to_dashboard_entry(system) for system in
+                                             systems_col.find({'username': username}, DASHBOARD_PROJECTION).sort('name', 1)]
+    app.router.add_get('/systems/stream', systems_stream)
+    app.router.add_get('/systems/stream/stats', stream_stats)
+
+    if events_col is not None:
+        stopping = threading.Event()
+
+        async def start_tailing(app):
+            loop = asyncio.get_running_loop()
+            publish = lambda username, event: loop.call_soon_threadsafe(app['broker'].publish, username, event)
+            app['tailer'] = threading.Thread(target=tail_events, args=(events_col, publish, stopping, poll_interval),
+                                             name="status-tailer", daemon=True)
+            app['tailer'].start()
+
+        async def stop_tailing(app):
+            stopping.set()
+
+        app.on_startup.append(start_tailing)
+        app.on_cleanup.append(stop_tailing)
+    return app
+
+
+if __name__ == '__main__':
+    db = MongoClient(os.getenv('MONGO_URI', 'mongodb://localhost:27017'))["mydb"]
+    ensure_collections(db)  # status_events has to be capped before anything writes to it
+    web.run_app(create_app(db["systems"], db[STATUS_EVENTS_COLLECTION]), port=int(os.getenv('STREAM_PORT', '5001')))
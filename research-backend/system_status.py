@@ -0,0 +1,50 @@
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from datetime import datetime, timezone
+
+# Fields the dashboard needs from a system document
+DASHBOARD_PROJECTION = {'name': 1, 'status': 1, 'confidence': 1, 'lastUpdated': 1}
+
+
+def parse_timestamp(value):
+    # Client-supplied ISO 8601 time -> naive UTC like everything else stored, so offsets such as
+    # '...+02:00' don't shift readings into the wrong rollup bucket. None/'' means now.
+    # Raises ValueError for anything that isn't an ISO 8601 string
+    if value is None or value == '':
+        return datetime.utcnow()
+    if not isinstance(value, str):
+        raise ValueError(f"Expected an ISO 8601 string, got {type(value).__name__}")
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def store_latest_status(systems_col, system_id, status, confidence=None, captured_at=None):
+    # Write-path for inference results: the dashboard only ever reads what is stored here.
+    # Returns the system document as it was before the update (None if it doesn't exist)
+    update = {
+        'status': status.lower(),
+        'lastUpdated': captured_at or datetime.utcnow(),
+    }
+    if confidence is not None:
+        update['confidence'] = float(confidence)
+
+    return systems_col.find_one_and_update(
+        {'_id': ObjectId(system_id)},
+        {'$set': update},
+        return_document=ReturnDocument.BEFORE
+    )
+
+
+def to_dashboard_entry(system):
+    last_updated = system.get('lastUpdated')
+    confidence = system.get('confidence')
+    return {
+        'id': str(system['_id']),
+        'name': system['name'],
+        'status': system.get('status', 'unknown'),
+        'lastUpdated': last_updated.isoformat() if isinstance(last_updated, datetime) else last_updated,
+        'confidence': round(confidence * 100, 2) if confidence is not None else None,
+        'imageUrl': f"/api/latest-image/{system['name']}"
+    }
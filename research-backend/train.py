@@ -0,0 +1,224 @@
+#Trains and evaluates the classifier from a dataset built with dataset.py, on CPU by default.
+#Usage:
+#  python train.py train ML/dataset --output "ML/Second Trial" [--epochs 10] [--batch-size 16] [--workers 4]
+#  python train.py eval ML/dataset --model "ML/Second Trial" [--split val|all] [--report eval.json]
+#Images are assigned to the validation split by a hash of their source path, so the split stays the same
+#when the dataset is rebuilt with more images. Checkpoints load anywhere ml_scripts does (MODEL_PATH=...).
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import time
+import torch
+from torch import nn
+from torch.utils.data import DataLoader
+from dataset import ShardedImageDataset
+from ml_scripts import MODEL_HEIGHT, MODEL_WIDTH, build_model, load_checkpoint
+
+
+def configure_threads(threads, workers):
+    #Loader workers decode/copy batches in their own processes; give the rest of the cores to torch's kernels
+    threads = threads or max(1, (os.cpu_count() or 1) - workers)
+    torch.set_num_threads(threads)
+    return threads
+
+
+def split_indices(dataset, split, val_percent):
+    if split == 'all':
+        return list(range(len(dataset)))
+    in_val = [int(hashlib.sha1(str(path).encode()).hexdigest(), 16) % 100 < val_percent for path in dataset.paths]
+    return [i for i, is_val in enumerate(in_val) if is_val == (split == 'val')]
+
+
+def loader(dataset, batch_size, workers, shuffle):
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=workers,
+                      pin_memory=torch.cuda.is_available(),  # Only helps host->GPU copies
+                      persistent_workers=workers > 0, prefetch_factor=4 if workers > 0 else None)
+
+
+def to_input(frames, device):
+    #uint8 NHWC -> float NCHW. Permuting an NHWC batch is already channels_last in memory, so this is one pass
+    return frames.to(device, non_blocking=True).permute(0, 3, 1, 2).float().div_(255)
+
+
+def augment(X):
+    #Batched, in-place stand-ins for the notebook's PIL ColorJitter/flip augmentation
+    flip = torch.rand(X.shape[0], device=X.device) < 0.5
+    X[flip] = X[flip].flip(-1)
+    brightness = torch.empty(X.shape[0], 1, 1, 1, device=X.device).uniform_(0.5, 1.5)
+    contrast = torch.empty(X.shape[0], 1, 1, 1, device=X.device).uniform_(0.5, 1.5)
+    mean = X.mean(dim=(1, 2, 3), keepdim=True)
+    return X.mul_(brightness).sub_(mean).mul_(contrast).add_(mean).clamp_(0, 1)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def dataset_fingerprint(root):
+    with open(os.path.join(root, 'manifest.json'), 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+
+def save_checkpoint(model, path, metadata):
+    #Written to a temp file first so a crash never leaves a half-written model where the server looks for it
+    torch.save({'state_dict': model.state_dict(), 'metadata': metadata}, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+
+def evaluate(model, data, device, num_classes):
+    model.eval()
+    confusion = torch.zeros(num_classes, num_classes, dtype=torch.int64)
+    loss_function = nn.CrossEntropyLoss(reduction='sum')
+    total_loss = 0.0
+    images = 0
+    forward_time = 0.0
+
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for frames, y in data:
+            X = to_input(frames, device)
+            forward_start = time.perf_counter()
+            preds = model(X)
+            forward_time += time.perf_counter() - forward_start
+
+            total_loss += loss_function(preds, y.to(device)).item()
+            confusion += torch.bincount(y * num_classes + preds.argmax(dim=1).cpu(), minlength=num_classes ** 2).view(num_classes, num_classes)
+            images += len(y)
+    elapsed = time.perf_counter() - start
+
+    correct = confusion.diag()
+    return {
+        'images': images,
+        'loss': round(total_loss / images, 4) if images else None,
+        'accuracy': round(correct.sum().item() / images, 4) if images else None,
+        'per_class_recall': [round(c / n, 4) if n else None for c, n in zip(correct.tolist(), confusion.sum(dim=1).tolist())],
+        'per_class_precision': [round(c / n, 4) if n else None for c, n in zip(correct.tolist(), confusion.sum(dim=0).tolist())],
+        'confusion_matrix': confusion.tolist(),  # Rows are true labels, columns predictions
+        'images_per_sec': round(images / elapsed, 2) if elapsed else None,
+        'model_images_per_sec': round(images / forward_time, 2) if forward_time else None,
+    }
+
+
+def train(args):
+    device = torch.device(args.device)
+    threads = configure_threads(args.threads, args.workers)
+    torch.manual_seed(args.seed)
+
+    dataset = ShardedImageDataset(args.data)
+    num_classes = len(dataset.classes)
+    train_set = dataset.subset(split_indices(dataset, 'train', args.val_percent))
+    val_set = dataset.subset(split_indices(dataset, 'val', args.val_percent))
+    train_data = loader(train_set, args.batch_size, args.workers, shuffle=True)
+    val_data = loader(val_set, args.batch_size, args.workers, shuffle=False)
+    print(f"Training on {len(train_set)} images, validating on {len(val_set)} ({device}, {threads} threads, {args.workers} loader workers)")
+
+    model = build_model(out_channels=num_classes)
+    with torch.no_grad():
+        model(torch.zeros(1, 3, MODEL_HEIGHT, MODEL_WIDTH))  # Materialize LazyLinear before the optimizer sees the parameters
+    model = model.to(device, memory_format=torch.channels_last)
+    loss_function = nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+
+    metadata = {
+        'version': f"{os.path.basename(args.output)}-{time.strftime('%Y%m%d-%H%M%S')}",
+        'classes': dataset.classes,
+        'input_shape': [3, MODEL_HEIGHT, MODEL_WIDTH],
+        'git_commit': git_commit(),
+        'dataset': {'path': os.path.abspath(args.data), 'fingerprint': dataset_fingerprint(args.data),
+                    'train_images': len(train_set), 'val_images': len(val_set), 'val_percent': args.val_percent},
+        'hyperparameters': {'epochs': args.epochs, 'batch_size': args.batch_size, 'lr': args.lr, 'seed': args.seed},
+        'torch': str(torch.__version__),
+    }
+
+    best_accuracy = -1.0
+    history = []
+    for epoch in range(args.epochs):
+        model.train()
+        start = time.perf_counter()
+        total_loss, images = 0.0, 0
+        for frames, y in train_data:
+            X = augment(to_input(frames, device)) if args.augment else to_input(frames, device)
+            y = y.to(device)
+            loss = loss_function(model(X), y)
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item() * len(y)
+            images += len(y)
+        train_time = time.perf_counter() - start
+
+        report = evaluate(model, val_data, device, num_classes) if len(val_set) else {}
+        history.append({'epoch': epoch, 'train_loss': round(total_loss / max(images, 1), 4),
+                        'train_images_per_sec': round(images / train_time, 2),
+                        'val_loss': report.get('loss'), 'val_accuracy': report.get('accuracy')})
+        print(json.dumps(history[-1]))
+
+        metadata.update(epoch=epoch, val_accuracy=report.get('accuracy'), history=history)
+        save_checkpoint(model, f"{args.output}.last", metadata)
+        accuracy = report.get('accuracy') or 0.0
+        if accuracy > best_accuracy:
+            best_accuracy = accuracy
+            save_checkpoint(model, args.output, metadata)
+            print(f"Saved {args.output} (val accuracy {accuracy})")
+
+    return metadata
+
+
+def evaluate_checkpoint(args):
+    device = torch.device(args.device)
+    threads = configure_threads(args.threads, args.workers)
+
+    state_dict, metadata = load_checkpoint(args.model, device)
+    dataset = ShardedImageDataset(args.data)
+    classes = metadata.get('classes', dataset.classes)
+    model = build_model(out_channels=len(classes) if 'classes' in metadata else 2)
+    model.load_state_dict(state_dict)
+    model = model.to(device, memory_format=torch.channels_last)
+
+    val_percent = metadata.get('dataset', {}).get('val_percent', args.val_percent)
+    data = loader(dataset.subset(split_indices(dataset, args.split, val_percent)), args.batch_size, args.workers, shuffle=False)
+    report = evaluate(model, data, device, len(classes))
+    return {'model': args.model, 'version': metadata.get('version'), 'classes': classes, 'split': args.split,
+            'threads': threads, 'workers': args.workers, 'batch_size': args.batch_size, **report}
+
+
+if __name__ == '__main__':
+    #Options shared by both commands, so they can follow the subcommand: train.py eval data --model m --batch-size 64
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--device', default='cpu')
+    common.add_argument('--workers', type=int, default=min(4, (os.cpu_count() or 1) - 1), help='DataLoader worker processes')
+    common.add_argument('--threads', type=int, default=None, help='torch intra-op threads (default: cores not used by workers)')
+    common.add_argument('--batch-size', type=int, default=16)
+    common.add_argument('--val-percent', type=int, default=20)
+
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    train_parser = commands.add_parser('train', parents=[common])
+    train_parser.add_argument('data')
+    train_parser.add_argument('--output', required=True)
+    train_parser.add_argument('--epochs', type=int, default=10)
+    train_parser.add_argument('--lr', type=float, default=0.001)
+    train_parser.add_argument('--seed', type=int, default=42)
+    train_parser.add_argument('--no-augment', dest='augment', action='store_false')
+
+    eval_parser = commands.add_parser('eval', parents=[common])
+    eval_parser.add_argument('data')
+    eval_parser.add_argument('--model', required=True)
+    eval_parser.add_argument('--split', choices=('val', 'train', 'all'), default='val')
+    eval_parser.add_argument('--report', help='also write the report to this JSON file')
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        train(args)
+    else:
+        report = evaluate_checkpoint(args)
+        print(json.dumps(report, indent=2))
+        if args.report:
+            with open(args.report, 'w') as f:
+                json.dump(report, f, indent=2)
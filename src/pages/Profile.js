@@ -112,8 +112,8 @@ function Profile() {
       .then((res) => res.json())
       .then((data) => {
         if (data.success) {
-          // Reload the photo with a fresh timestamp to bust cache
-          fetch(`http://127.0.0.1:5000/profile_photo/${encodeURIComponent(username)}?t=${Date.now()}`)
+          // The version is the photo's content hash, so this URL is safe for the browser to cache
+          fetch(`http://127.0.0.1:5000/profile_photo/${encodeURIComponent(username)}?v=${data.version}`)
             .then((res) => res.blob())
             .then((blob) => {
               setProfilePhoto(URL.createObjectURL(blob));
@@ -15,6 +15,41 @@ function Data() {
     fetchSystemsData();
   }, []);
 
+  // Status changes are pushed by the stream server (research-backend/status_stream.py). While it is
+  // unreachable the browser keeps reconnecting and the page falls back to re-polling /get_systems_data
+  useEffect(() => {
+    if (!username) return;
+
+    let fallback = null;
+    const stopFallback = () => {
+      clearInterval(fallback);
+      fallback = null;
+    };
+
+    const stream = new EventSource(`http://127.0.0.1:5001/systems/stream?username=${username}`);
+    stream.addEventListener('snapshot', (event) => {
+      stopFallback();
+      setSystems(JSON.parse(event.data));
+      setLoading(false);
+    });
+    stream.addEventListener('status', (event) => {
+      const update = JSON.parse(event.data);
+      setSystems((current) => current.map((system) => (
+        system.id === update.id ? { ...system, ...update } : system
+      )));
+    });
+    stream.addEventListener('error', () => {
+      if (fallback) return;
+      fetchSystemsData();
+      fallback = setInterval(fetchSystemsData, 30000);
+    });
+
+    return () => {
+      stopFallback();
+      stream.close();
+    };
+  }, [username]);
+
   const fetchSystemsData = async () => {
     if (!username) return;
 